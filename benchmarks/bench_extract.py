@@ -0,0 +1,148 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Extraction speed of the AO3 listing parsers.
+
+    python benchmarks/bench_extract.py [--page FILE] [--blurbs N] [--runs N]
+
+Runs against a saved listing page if --page is given, else against a
+generated page with the same markup as an AO3 works listing. The "before"
+run is the old extraction: html.parser on the whole page, then the headings
+parsed a second time & two regex find_all passes.
+"""
+
+import argparse
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+from fichub_cli_metadata.utils import extract
+
+URL = "https://archiveofourown.org/tags/Fluff/works?page=2"
+
+BLURB = """
+<li id="work_{n}" class="work blurb group work-{n} user-{n}" role="article">
+  <div class="header module">
+    <h4 class="heading">
+      <a href="/works/{n}">Title of the work {n}</a>
+      by
+      <a rel="author" href="/users/author{n}/pseuds/author{n}">author{n}</a>
+    </h4>
+    <h5 class="fandoms heading">
+      <span class="landmark">Fandoms:</span>
+      <a class="tag" href="/tags/Harry%20Potter%20-%20J*d*%20K*d*%20Rowling/works">Harry Potter - J. K. Rowling</a>
+    </h5>
+    <ul class="required-tags">
+      <li><a class="help symbol question modal" title="Symbols key" href="/help/symbols-key.html"><span class="rating-teen rating" title="Teen And Up Audiences"><span class="text">Teen And Up Audiences</span></span></a></li>
+      <li><span class="category-slash category" title="M/M"><span class="text">M/M</span></span></li>
+      <li><span class="complete-yes iswip" title="Complete Work"><span class="text">Complete Work</span></span></li>
+    </ul>
+    <p class="datetime">12 Jun 2022</p>
+  </div>
+  <h6 class="landmark heading">Tags</h6>
+  <ul class="tags commas">
+    {tags}
+  </ul>
+  <h6 class="landmark heading">Summary</h6>
+  <blockquote class="userstuff summary">
+    <p>A fairly long summary of the story, with <em>some</em> markup in it. {n}</p>
+    <p>Second paragraph of the summary.</p>
+  </blockquote>
+  <h6 class="landmark heading">Series</h6>
+  <ul class="series">
+    <li>Part <strong>{part}</strong> of <a href="/series/{series}">Series {series}</a></li>
+  </ul>
+  <dl class="stats">
+    <dt class="language">Language:</dt><dd class="language">English</dd>
+    <dt class="words">Words:</dt><dd class="words">12,345</dd>
+    <dt class="chapters">Chapters:</dt><dd class="chapters"><a href="/works/{n}/chapters/1">3</a>/3</dd>
+    <dt class="kudos">Kudos:</dt><dd class="kudos"><a href="/works/{n}/kudos">1,234</a></dd>
+    <dt class="hits">Hits:</dt><dd class="hits">45,678</dd>
+  </dl>
+</li>
+"""
+
+TAG = '<li class="freeforms"><a class="tag" href="/tags/Tag%20{i}/works">Tag {i}</a></li>'
+
+
+def make_page(blurbs: int):
+    tags = "".join(TAG.format(i=i) for i in range(15))
+    pagination = '<ol class="pagination actions" role="navigation" title="pagination">' + \
+        '<li class="previous"><a rel="prev" href="/tags/Fluff/works?page=1">← Previous</a></li>' + \
+        "".join(f'<li><a href="/tags/Fluff/works?page={i}">{i}</a></li>' for i in (1, 2, 3, 4, 5, 1000)) + \
+        '<li class="next"><a rel="next" href="/tags/Fluff/works?page=3">Next →</a></li></ol>'
+    works = "".join(BLURB.format(n=n, tags=tags, part=n % 5 + 1, series=n // 5)
+                    for n in range(blurbs))
+    header = '<html><head><title>Works | Archive of Our Own</title></head><body>' + \
+        '<div id="header"><ul class="primary navigation actions">' + \
+        "".join(f'<li><a href="/menu/{i}">Menu {i}</a></li>' for i in range(50)) + '</ul></div>'
+    return (header + pagination + f'<ol class="work index group">{works}</ol>' +
+            pagination + '</body></html>').encode()
+
+
+def parse_listing_before(content: bytes, url: str):
+    html_page = BeautifulSoup(content, 'html.parser')
+
+    ao3_series_works_html = ""
+    for i in html_page.find_all('h4', attrs={'class': 'heading'}):
+        ao3_series_works_html += str(i)
+
+    ao3_urls = BeautifulSoup(ao3_series_works_html, 'html.parser')
+
+    works = ["https://archiveofourown.org" + tag['href'] for tag in
+             ao3_urls.find_all('a', {'href': re.compile('/works/')})]
+    series = ["https://archiveofourown.org" + tag['href'] for tag in
+              ao3_urls.find_all('a', {'href': re.compile('/series/')})]
+    return works, series
+
+
+def run(parse, content: bytes, runs: int):
+    start = time.perf_counter()
+    for _ in range(runs):
+        listing = parse(content, URL)
+    return (time.perf_counter() - start) / runs * 1000, listing[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--page", help="saved AO3 listing page")
+    parser.add_argument("--blurbs", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.page:
+        with open(args.page, "rb") as f:
+            content = f.read()
+    else:
+        content = make_page(args.blurbs)
+
+    parsers = [("before (html.parser x2)", parse_listing_before),
+               ("soup + strainer", extract.parse_listing_soup)]
+    if extract.lxml_html is not None:
+        parsers.append(("lxml", extract.parse_listing_lxml))
+
+    print(f"page: {len(content) / 1024:.0f} KiB")
+    print(f"{'parser':<26}{'ms/page':>10}{'works':>8}")
+    expected = None
+    for name, parse in parsers:
+        ms, works = run(parse, content, args.runs)
+        if expected is None:
+            expected = works
+        assert works == expected, f"{name} found different works urls"
+        print(f"{name:<26}{ms:>10.2f}{len(works):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Bulk-ingest throughput of the db write path for each SQLite profile.
+
+    python benchmarks/bench_ingest.py [--rows N]
+
+The "before" run mimics the old write path: default pragmas & one commit
+per row. The other runs use the batched upsert with each profile.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from fichub_cli_metadata.utils import crud, migrations
+from fichub_cli_metadata.utils.processing import init_database, get_db, DB_PROFILES
+
+config = {'db_up_time_format': r'%Y-%m-%dT%H:%M:%S%z',
+          'fic_up_time_format': r'%Y-%m-%dT%H:%M:%S'}
+
+
+def make_item(n: int):
+    return {
+        "id": f"fichub{n}", "title": f"Title {n}", "author": f"author{n % 100}",
+        "authorLocalId": n % 100, "authorUrl": "https://archiveofourown.org/users/a",
+        "chapters": n % 40, "created": "2020-01-02T03:04:05",
+        "description": "A fairly long summary of the story. " * 5,
+        "status": "ongoing", "words": n * 10, "updated": "2021-05-06T07:08:09",
+        "source": f"https://archiveofourown.org/works/{n}",
+        "rawExtendedMeta": {"id": n, "rated": "Teen", "language": "English",
+                            "genres": "Romance, Drama", "characters": "A, B",
+                            "reviews": n % 50, "favorites": n % 70,
+                            "follows": n % 30, "raw_fandom": "Fandom"},
+        "extraMeta": None
+    }
+
+
+def run(rows: int, profile: str, batch_size: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine, SessionLocal = init_database(
+            os.path.join(tmp_dir, "bench.sqlite"), profile)
+        migrations.migrate(engine, lambda suffix: None, False)
+        db = next(get_db(SessionLocal))
+        items = [make_item(n) for n in range(rows)]
+
+        start = time.perf_counter()
+        # silence the per-batch console output
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            # the write path of the CLI, one transaction per batch
+            writer = crud.BatchWriter(db, config, True, False,
+                                      batch_size=batch_size,
+                                      flush_interval=float("inf"))
+            for item in items:
+                writer.add(item["source"], item)
+            writer.flush()
+        elapsed = time.perf_counter() - start
+
+        db.close()
+        engine.dispose()
+    return rows / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'run':<28}{'rows/s':>12}")
+    print(f"{'before (default, 1 row/tx)':<28}{run(args.rows, 'default', 1):>12.0f}")
+    for profile in DB_PROFILES:
+        print(f"{profile + f' ({args.batch_size} rows/tx)':<28}"
+              f"{run(args.rows, profile, args.batch_size):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
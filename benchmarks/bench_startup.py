@@ -0,0 +1,87 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Startup time of the CLI.
+
+    python benchmarks/bench_startup.py [--runs N]
+
+Shows the slowest imports of `fichub_cli_metadata.cli` (python -X importtime)
+& the wall time of `--version`, with the startup of a bare interpreter
+subtracted. --version should stay under 100 ms.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+VERSION = ("import sys; from fichub_cli_metadata.cli import app; "
+           "sys.argv = ['fichub_cli_metadata', '--version']; app()")
+BUDGET_MS = 100
+
+
+def wall_time(code: str, runs: int):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def slowest_imports(count: int = 10):
+    """ The modules imported by the package, sorted by their cumulative
+        import time
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import fichub_cli_metadata.cli"],
+        check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented by 2 spaces per level & printed
+        # before the module which imported them
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip().startswith("fichub_cli_metadata"):
+                break
+            imports = []
+        elif depth <= 3:
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'import':<40}{'ms':>8}")
+    for ms, name in slowest_imports():
+        print(f"{name:<40}{ms:>8.1f}")
+
+    bare = wall_time("pass", args.runs)
+    version = wall_time(VERSION, args.runs)
+    print(f"\n{'bare interpreter':<40}{bare:>8.1f}")
+    print(f"{'--version':<40}{version:>8.1f}")
+    print(f"{'--version over the interpreter':<40}{version - bare:>8.1f}"
+          f"  ({'ok' if version - bare < BUDGET_MS else 'over'} the {BUDGET_MS} ms budget)")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,33 +14,27 @@
 
 import typer
 import sys
-import os
+from typing import List
 from platformdirs import PlatformDirs
-from loguru import logger
 from datetime import datetime
 from colorama import init, Fore, Style
 
-from .utils.fetch_data import FetchData
-from fichub_cli.utils.processing import get_format_type, check_cli_outdated,\
-    appdir_exists_check, appdir_builder, appdir_config_info, output_log_cleanup
 from fichub_cli_metadata import __version__
 
+# The modules for the db, the requests & the parsing are imported in
+# metadata() when they are needed, so that --version & --help start fast
 
 init(autoreset=True)  # colorama init
 app = typer.Typer(add_completion=False)
 app_dirs = PlatformDirs("fichub_cli", "fichub")
 
-# check if app directory exists, if not, create it
-appdir_exists_check(app_dirs)
-
-# check if the cli is outdated
-check_cli_outdated("fichub-cli-metadata", __version__)
-
 
 # @logger.catch  # for internal debugging
 @app.callback(no_args_is_help=True,
               invoke_without_command=True)
 def metadata(
+    ctx: typer.Context,
+
     input: str = typer.Option(
         "", "-i", "--input", help="Input: Either an URL or path to a file"),
 
@@ -50,9 +44,30 @@ def metadata(
     update_db: bool = typer.Option(
         False, "--update-db", help="Self-Update existing db (--input-db required)", is_flag=True),
 
+    incremental: bool = typer.Option(
+        False, "--incremental", help="Only update the fics which are due for a refresh (--update-db required)", is_flag=True),
+
+    complete_ttl: int = typer.Option(
+        90, "--complete-ttl", min=0, help="Days after which a completed fic is refreshed in the --incremental mode"),
+
     export_db: bool = typer.Option(
         False, "--export-db", help="Export the existing db as json (--input-db required)", is_flag=True),
 
+    export_format: str = typer.Option(
+        "json", "--export-format", help="Format for --export-db: json (default), ndjson, csv or parquet"),
+
+    since: datetime = typer.Option(
+        None, "--since", help="Only export the rows updated in the db since this date/time (local time)"),
+
+    db_profile: str = typer.Option(
+        "fast", "--db-profile", help="SQLite performance profile: fast (default, WAL journal), default (SQLite defaults) or bulk (fastest, not crash safe)"),
+
+    no_backup: bool = typer.Option(
+        False, "--no-backup", help="Dont backup the db before updating or migrating it", is_flag=True),
+
+    keep_backups: int = typer.Option(
+        0, "--keep-backups", min=0, help="Number of backup dbs to keep, older ones are deleted (default: keep all)"),
+
     out_dir: str = typer.Option(
         "", "-o", "--out-dir", help="Path to the Output directory (default: Current Directory)"),
 
@@ -62,6 +77,39 @@ def metadata(
     fetch_urls: str = typer.Option(
         "", help="Fetch all story urls found from a page. Currently supports archiveofourown.org only"),
 
+    ingest: bool = typer.Option(
+        False, "--ingest", help="Save the metadata of the story urls found by --fetch-urls directly in the db, instead of the url lists", is_flag=True),
+
+    pages: str = typer.Option(
+        "", "--pages", help="Crawl the pages of the listing for --fetch-urls: a range e.g. 1-20, 5- or all to follow the pagination to the last page"),
+
+    workers: int = typer.Option(
+        4, "--workers", min=1, help="Number of metadata (or --fetch-urls page) requests to keep in flight"),
+
+    batch_size: int = typer.Option(
+        100, "--batch-size", min=1, help="Number of rows to write to the db per transaction"),
+
+    rate_limit: str = typer.Option(
+        "", "--rate-limit", help="Requests per second, either for all hosts e.g. 2 or per host e.g. fichub.net=5,archiveofourown.org=1 (default: 5, archiveofourown.org: 1, 0: no limit)"),
+
+    max_retries: int = typer.Option(
+        3, "--max-retries", min=0, help="Number of times the failed urls are retried at the end of the run"),
+
+    cache_ttl: float = typer.Option(
+        24, "--cache-ttl", min=0, help="Hours for which the cached metadata of an url is used instead of fetching it again (--update-db always revalidates)"),
+
+    cache_size: int = typer.Option(
+        256, "--cache-size", min=0, help="Size of the metadata cache in MB, the least recently used entries are evicted"),
+
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Dont read or write the metadata cache", is_flag=True),
+
+    offline: bool = typer.Option(
+        False, "--offline", help="Build or update the db from the metadata cache only, without any requests", is_flag=True),
+
+    resume: bool = typer.Option(
+        False, "--resume", help="Continue the last interrupted run on the db, skipping the urls it already finished (--input-db required)", is_flag=True),
+
     verbose: bool = typer.Option(
         False, "-v", "--verbose", help="Show fic stats", is_flag=True),
 
@@ -103,6 +151,21 @@ def metadata(
     Failed downloads will be saved in the `err.log` file in the current directory
     """
 
+    if version is True:
+        typer.echo(f"fichub-cli-metadata: v{__version__}")
+        sys.exit(0)
+
+    from .utils.version_check import check_cli_outdated
+    from fichub_cli.utils.processing import get_format_type, appdir_exists_check, \
+        appdir_builder, appdir_config_info, output_log_cleanup
+
+    # check if app directory exists, if not, create it
+    appdir_exists_check(app_dirs)
+
+    # check if the cli is outdated, in the background
+    check_cli_outdated("fichub-cli-metadata", __version__,
+                       app_dirs.user_cache_dir)
+
     if config_init:
         # initialize/overwrite the config files
         appdir_builder(app_dirs)
@@ -111,7 +174,12 @@ def metadata(
         # overwrite the config files
         appdir_config_info(app_dirs)
 
+    # the subcommands e.g. search handle their own options
+    if ctx.invoked_subcommand is not None:
+        return
+
     if debug_log:
+        from loguru import logger
         timestamp = datetime.now().strftime("%Y-%m-%d T%H%M%S")
         logger.remove()  # remove all existing handlers
         logger.add(f"fichub_cli_metadata - {timestamp}.log")
@@ -126,11 +194,41 @@ def metadata(
     else:
         format_type = []
 
+    from .utils.fetch_data import FetchData
+    from .utils.ratelimit import parse_rate_limits
+    from .utils.extract import parse_pages
+
+    try:
+        rate_limits = parse_rate_limits(rate_limit)
+    except ValueError as e:
+        typer.echo(Fore.RED + str(e))
+        sys.exit(1)
+
+    try:
+        pages = parse_pages(pages) if pages else None
+    except ValueError as e:
+        typer.echo(Fore.RED + str(e))
+        sys.exit(1)
+
+    if resume and not input_db:
+        typer.echo(Fore.RED + "--resume needs the db of the interrupted run, use --input-db")
+        sys.exit(1)
+
+    if offline and (no_cache or format_type or fetch_urls):
+        typer.echo(Fore.RED + "--offline only works with the metadata cache, it cant be used with --no-cache, --download-ebook or --fetch-urls")
+        sys.exit(1)
+
     if input and not update_db:
         fic = FetchData(debug=debug, automated=automated, format_type=format_type,
                         out_dir=out_dir, input_db=input_db, update_db=update_db,
                         export_db=export_db, force=force, verbose=verbose,
-                        changelog=changelog)
+                        changelog=changelog, workers=workers,
+                        batch_size=batch_size, no_backup=no_backup,
+                        keep_backups=keep_backups, db_profile=db_profile,
+                        resume=resume, rate_limits=rate_limits,
+                        max_retries=max_retries, cache_ttl=cache_ttl,
+                        cache_size=cache_size, no_cache=no_cache,
+                        offline=offline)
         fic.save_metadata(input)
 
     if input_db and update_db:
@@ -138,22 +236,39 @@ def metadata(
         fic = FetchData(debug=debug, automated=automated, format_type=format_type,
                         out_dir=out_dir, input_db=input_db, update_db=update_db,
                         export_db=export_db, force=force, verbose=verbose,
-                        changelog=changelog)
+                        changelog=changelog, workers=workers,
+                        batch_size=batch_size, incremental=incremental,
+                        complete_ttl=complete_ttl, no_backup=no_backup,
+                        keep_backups=keep_backups, db_profile=db_profile,
+                        resume=resume, rate_limits=rate_limits,
+                        max_retries=max_retries, cache_ttl=cache_ttl,
+                        cache_size=cache_size, no_cache=no_cache,
+                        offline=offline)
         fic.update_metadata()
 
     if export_db:
         fic = FetchData(debug=debug, automated=automated, changelog=changelog,
                         out_dir=out_dir, input_db=input_db, update_db=update_db,
-                        export_db=export_db, force=force, verbose=verbose)
+                        export_db=export_db, force=force, verbose=verbose,
+                        export_format=export_format, export_since=since,
+                        db_profile=db_profile)
         fic.export_db_as_json()
 
-    if fetch_urls:
-        fic = FetchData(debug=debug)
-        fic.fetch_urls_from_page(fetch_urls)
-
-    if version is True:
-        from . import __version__
-        typer.echo(f"fichub-cli-metadata: v{__version__}")
+    if fetch_urls and ingest:
+        fic = FetchData(debug=debug, automated=automated, format_type=format_type,
+                        out_dir=out_dir, input_db=input_db, force=force,
+                        verbose=verbose, changelog=changelog, workers=workers,
+                        batch_size=batch_size, no_backup=no_backup,
+                        keep_backups=keep_backups, db_profile=db_profile,
+                        resume=resume, rate_limits=rate_limits,
+                        max_retries=max_retries, cache_ttl=cache_ttl,
+                        cache_size=cache_size, no_cache=no_cache)
+        fic.ingest_from_page(fetch_urls, pages=pages)
+
+    elif fetch_urls:
+        fic = FetchData(debug=debug, workers=workers, rate_limits=rate_limits,
+                        max_retries=max_retries)
+        fic.fetch_urls_from_page(fetch_urls, pages=pages)
 
     try:
         if fic.exit_status == 1:
@@ -165,6 +280,132 @@ def metadata(
         sys.exit(fic.exit_status)
 
     # FileNotFoundError: output.log doesnt exist, when run 1st time
-    # UnboundLocalError: 'fic' is not assigned value for --version flag
+    # UnboundLocalError: 'fic' is not assigned value e.g. for --config-info
     except (FileNotFoundError, UnboundLocalError):
         sys.exit(0)
+
+
+@app.command()
+def search(
+    query: str = typer.Argument(
+        ..., help="Words to find in the title, description, author & fandom. A word ending with * matches as a prefix e.g. drag*, title:word only searches the title"),
+
+    input_db: str = typer.Option(
+        ..., "--input-db", help="The sqlite db to search"),
+
+    limit: int = typer.Option(
+        20, "--limit", min=1, help="Number of results per page"),
+
+    page: int = typer.Option(
+        1, "--page", min=1, help="Page of the results to show"),
+
+    debug: bool = typer.Option(
+        False, "-d", "--debug", help="Show the log in the console for debugging", is_flag=True),
+):
+    """
+    Full-text search of the fics in a db, best match first
+    """
+    from .utils.fetch_data import FetchData
+
+    fic = FetchData(debug=debug, input_db=input_db)
+    fic.search_db(query, limit, page)
+    sys.exit(fic.exit_status)
+
+
+@app.command()
+def query(
+    input_db: str = typer.Option(
+        ..., "--input-db", help="The sqlite db to query"),
+
+    author: str = typer.Option(
+        None, "--author", help="Only the fics by this author"),
+
+    status: str = typer.Option(
+        None, "--status", help="Only the fics with this status e.g. complete or ongoing"),
+
+    rated: str = typer.Option(
+        None, "--rated", help="Only the fics with this rating e.g. T"),
+
+    min_words: int = typer.Option(
+        None, "--min-words", min=0, help="Only the fics with at least this many words"),
+
+    max_words: int = typer.Option(
+        None, "--max-words", min=0, help="Only the fics with at most this many words"),
+
+    updated_since: datetime = typer.Option(
+        None, "--updated-since", help="Only the fics updated since this date/time (local time)"),
+
+    tag: List[str] = typer.Option(
+        [], "--tag", help="Only the fics with this tag, as kind:name e.g. character:Harry P. Kinds: genre, character, fandom. Can be used multiple times"),
+
+    columns: str = typer.Option(
+        "title,author,status,words,fic_last_updated,source", "--columns", help="Comma separated columns to show"),
+
+    sort: str = typer.Option(
+        None, "--sort", help="Column to sort by, prefixed with - for descending order e.g. -words"),
+
+    limit: int = typer.Option(
+        0, "--limit", min=0, help="Maximum number of rows (default: all)"),
+
+    output_format: str = typer.Option(
+        "table", "--format", help="Output format: table (default), ndjson, csv or json"),
+
+    out_file: str = typer.Option(
+        "-", "-o", "--out-file", help="Save the output to a file (default: stdout)"),
+
+    debug: bool = typer.Option(
+        False, "-d", "--debug", help="Show the log in the console for debugging", is_flag=True),
+):
+    """
+    List the fics in a db matching the filters, without loading the whole db
+    """
+    from .utils.fetch_data import FetchData
+
+    tags = []
+    for value in tag:
+        kind, sep, name = value.partition(":")
+        if not sep or not name.strip():
+            typer.echo(Fore.RED + f"Invalid tag: {value}. Use kind:name e.g. genre:Romance")
+            sys.exit(1)
+        tags.append((kind.strip().lower(), name.strip()))
+
+    filters = {"author": author, "status": status, "rated": rated,
+               "min_words": min_words, "max_words": max_words,
+               "updated_since": updated_since, "tags": tags}
+    fic = FetchData(debug=debug, input_db=input_db)
+    fic.query_db(list(dict.fromkeys(col.strip() for col in columns.split(",") if col.strip())),
+                 filters, sort, limit or None, output_format, out_file)
+    sys.exit(fic.exit_status)
+
+
+@app.command()
+def trending(
+    input_db: str = typer.Option(
+        ..., "--input-db", help="The sqlite db, updated regularly with --update-db"),
+
+    stat: str = typer.Option(
+        "favorites", "--by", help="Stat to rank the fics by: favorites (default), follows, reviews, words or chapters"),
+
+    days: float = typer.Option(
+        7, "--days", min=0, help="Size of the time window in days"),
+
+    limit: int = typer.Option(
+        20, "--limit", min=1, help="Number of fics to show"),
+
+    output_format: str = typer.Option(
+        "table", "--format", help="Output format: table (default), ndjson, csv or json"),
+
+    out_file: str = typer.Option(
+        "-", "-o", "--out-file", help="Save the output to a file (default: stdout)"),
+
+    debug: bool = typer.Option(
+        False, "-d", "--debug", help="Show the log in the console for debugging", is_flag=True),
+):
+    """
+    List the fics whose stats grew the most in the last days
+    """
+    from .utils.fetch_data import FetchData
+
+    fic = FetchData(debug=debug, input_db=input_db)
+    fic.trending_db(stat, days, limit, output_format, out_file)
+    sys.exit(fic.exit_status)
@@ -0,0 +1,124 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import urlsplit, urlunsplit
+
+CACHE_FILE = "metadata_cache.sqlite"
+
+# check the total size every this many writes
+EVICT_INTERVAL = 100
+
+# a cached response: the metadata, when it was fetched & the validators
+# (ETag, Last-Modified) of the response for the conditional requests
+CachedMeta = namedtuple("CachedMeta", ["meta", "fetched", "etag", "last_modified"])
+
+
+def normalize_source(url: str):
+    """ Cache key of an url: lowercase scheme & host, without the
+        fragment & the trailing slash
+    """
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path.rstrip("/"), parts.query, ""))
+
+
+class MetaCache:
+    """ On-disk cache of the metadata returned by the API, compressed with
+        zlib & keyed by the normalized source url. The least recently used
+        entries are evicted when the cache grows over `max_size` bytes.
+        Shared by the worker threads.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float, max_size: int):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.conn = sqlite3.connect(
+            os.path.join(cache_dir, CACHE_FILE), check_same_thread=False,
+            isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta_cache (url TEXT PRIMARY KEY, data BLOB, fetched REAL, accessed REAL, size INTEGER, etag TEXT, last_modified TEXT);")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_meta_cache_accessed ON meta_cache (accessed);")
+
+    def get(self, url: str):
+        """ Return the CachedMeta of the url (of any age) or None
+        """
+        key = normalize_source(url)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data, fetched, etag, last_modified FROM meta_cache WHERE url = ?;",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE meta_cache SET accessed = ? WHERE url = ?;",
+                              (time.time(), key))
+        data, fetched, etag, last_modified = row
+        return CachedMeta(json.loads(zlib.decompress(data)), fetched, etag,
+                          last_modified)
+
+    def hit(self, revalidated: bool = False):
+        with self.lock:
+            self.hits += 1
+            if revalidated:
+                self.revalidated += 1
+
+    def is_fresh(self, cached: CachedMeta):
+        return cached is not None and time.time() - cached.fetched < self.ttl
+
+    def put(self, url: str, meta: dict, etag: str = None,
+            last_modified: str = None):
+        data = zlib.compress(json.dumps(meta).encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta_cache VALUES (?, ?, ?, ?, ?, ?, ?);",
+                (normalize_source(url), data, now, now, len(data), etag,
+                 last_modified))
+            self.writes += 1
+            if self.writes % EVICT_INTERVAL == 0:
+                self._evict()
+
+    def touch(self, url: str):
+        """ Mark the entry as fetched now, after a 304 Not Modified
+        """
+        with self.lock:
+            self.conn.execute(
+                "UPDATE meta_cache SET fetched = ? WHERE url = ?;",
+                (time.time(), normalize_source(url)))
+
+    def _evict(self):
+        """ Keep the most recently used entries which fit in max_size
+        """
+        self.conn.execute(
+            "DELETE FROM meta_cache WHERE url IN (SELECT url FROM (SELECT url, SUM(size) OVER (ORDER BY accessed DESC, url) AS kept FROM meta_cache) WHERE kept > ?);",
+            (self.max_size,))
+
+    def close(self):
+        with self.lock:
+            self._evict()
+            self.conn.close()
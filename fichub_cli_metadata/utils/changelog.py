@@ -0,0 +1,74 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from datetime import datetime
+
+# (key, total line, section heading) in the order of the changelog
+SECTIONS = [
+    ("input", "Total URLs given as input", "URLs given as Input"),
+    ("dedup", "Total URLs after removing duplicates",
+     "URLs after removing duplicates"),
+    ("urls", "Total URLs after comparing with the output.log",
+     "URLs after comparing with the output.log"),
+    ("downloaded", "Total URLs/Files downloaded", "URLs/Files Downloaded"),
+    ("errors", "Total URLs causing Download Errors",
+     "URLs causing Download Errors"),
+    ("no_updates", "Total URLs without any updates", "URLs without any updates"),
+]
+
+
+class Changelog:
+    """ Counts the urls of each section. With --changelog, the urls are
+        also appended to a .part file as they come, which is turned into
+        the same CHANGELOG file as the CLI's at the end of the run
+    """
+
+    def __init__(self, out_dir: str = "", save: bool = False):
+        self.counts = {key: 0 for key, _, _ in SECTIONS}
+        self.file = None
+        if save:
+            timestamp = datetime.now().strftime("%Y-%m-%d T%H%M%S")
+            self.path = os.path.join(out_dir, f"CHANGELOG - {timestamp}.txt")
+            self.file = open(self.path + ".part", "w")
+
+    def add(self, section: str, url: str):
+        self.counts[section] += 1
+        if self.file is not None:
+            self.file.write(f"{section}\t{url}\n")
+
+    def save(self):
+        """ Write the CHANGELOG, one pass over the .part file per section
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+
+        with open(self.path, 'w') as file:
+            file.write("# Changelog\n")
+            for key, total, _ in SECTIONS:
+                file.write(f"{total}: {self.counts[key]}\n")
+
+            for key, _, heading in SECTIONS:
+                if not self.counts[key]:
+                    continue
+                file.write(f"\n\n## {heading}")
+                with open(self.path + ".part", "r") as part:
+                    for line in part:
+                        section, _, url = line.rstrip("\n").partition("\t")
+                        if section == key:
+                            file.write(f"\n{url}")
+
+        os.remove(self.path + ".part")
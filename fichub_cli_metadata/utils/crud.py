@@ -12,248 +12,433 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import sys
+import time
 from datetime import datetime
 from tqdm import tqdm
-import sys
-import os
 from colorama import Fore
 from loguru import logger
-from sqlalchemy.sql import text
+from sqlalchemy import select, func, delete
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
-from platformdirs import PlatformDirs
+from sqlalchemy.sql import text
 
 from . import models
-from .processing import get_ins_query, sql_to_json
+from .processing import get_ins_row, get_db_last_updated, get_tags, \
+    local_timestamp
+from .export import export_rows
 from .logging import db_not_found_log
-from fichub_cli.utils.processing import process_extendedMeta
 
-app_dirs = PlatformDirs("fichub_cli", "fichub")
 
+# stay below SQLITE_MAX_VARIABLE_NUMBER (999 on older SQLite builds)
+IN_CLAUSE_CHUNK = 500
+EXPORT_CHUNK_SIZE = 1000
 
-def insert_data(db: Session, item: dict, debug: bool):
-    """ Execute insert query for the db
-    """
+# bm25 with the title weighted over the author, fandom & description
+SEARCH_RANK = "bm25(fichub_search, 10.0, 1.0, 5.0, 2.0)"
 
-    exists = db.query(models.Metadata).filter(
-        models.Metadata.source == item['source']).first()
+TAG_INSERT = "INSERT OR IGNORE INTO fichub_tags (kind, name) VALUES (?, ?);"
+# link a fic to a tag by its (kind, name), using the unique tag index
+FIC_TAG_INSERT = "INSERT OR IGNORE INTO fichub_fic_tags (fic_id, tag_id) SELECT ?, id FROM fichub_tags WHERE kind = ? AND name = ?;"
 
-    if not exists:
-        query = get_ins_query(item)
-        db.add(query)
-        if debug:
-            logger.info("Adding metadata to the database.")
-        tqdm.write(Fore.GREEN +
-                   "Adding metadata to the database.")
-        db.commit()
-        return 0, 0
-    else:
-        if debug:
-            logger.info(
-                "Metadata already exists. Skipping. Use --force to force-update existing data.")
-        tqdm.write(Fore.RED +
-                   "Metadata already exists. Skipping. Use --force to force-update existing data.\n")
-        return 1, 2
 
+class BatchWriter:
+    """ Buffer the fetched metadata & write it to the db in a single
+        transaction per `batch_size` rows or every `flush_interval` seconds,
+        whichever comes first. A crash loses at most one uncommitted batch.
 
-def update_data(db: Session, item: dict, debug: bool):
-    """ Execute update query for the db
+        If a `run_id` is given, the checkpoint state of each url is written
+        in the same transaction as its row.
     """
-    try:
-        with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'r') as f:
-            config = json.load(f)
-    except FileNotFoundError as err:
-        tqdm.write(str(err))
-        tqdm.write(
-            Fore.GREEN + "Run `fichub_cli --config-init` to initialize the CLI config")
-        exit(1)
-
-    exists = db.query(models.Metadata).filter(
-        models.Metadata.source == item['source']).first()
-    if not exists:
-        query = get_ins_query(item)
-        db.add(query)
+
+    def __init__(self, db: Session, config: dict, update: bool, debug: bool,
+                 batch_size: int = 100, flush_interval: float = 5.0,
+                 source_index=None, run_id: int = None):
+        self.db = db
+        self.config = config
+        self.source_index = source_index
+        self.run_id = run_id
+        self.update = update
+        self.debug = debug
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.errors = []
+        self.last_flush = time.monotonic()
+
+    def add_error(self, url: str):
+        """ Queue the error checkpoint for an url which could not be fetched
+        """
+        if self.run_id is not None:
+            self.errors.append(url)
+
+    def add(self, url: str, item: dict):
+        """ Queue an item for writing. Returns the results of the batch
+            if this item triggered a flush, else an empty list. An item
+            whose row cant be built is only an error for its own url
+        """
+        try:
+            row = get_ins_row(item, self.config)
+        except Exception as e:
+            if self.debug:
+                logger.error(f"Invalid metadata for {url}: {e!r}")
+            tqdm.write(Fore.RED + f"Invalid metadata for {url}. Skipping.")
+            self.add_error(url)
+            return [(url, None)]
+
+        self.pending.append((url, row))
+        if len(self.pending) >= self.batch_size or \
+                time.monotonic() - self.last_flush >= self.flush_interval:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """ Write all the queued rows in one transaction. Returns a list
+            of (url, url_exit_status) tuples, url_exit_status is None if
+            the batch could not be written
+        """
+        pending, self.pending = self.pending, []
+        errors, self.errors = self.errors, []
+        self.last_flush = time.monotonic()
+        if not pending and not errors:
+            return []
+
+        # the whole batch is stamped with the same time
+        db_last_updated, db_last_updated_ts = get_db_last_updated(self.config)
+        rows = {}
+        for _, row in pending:
+            row.update(db_last_updated=db_last_updated,
+                       db_last_updated_ts=db_last_updated_ts)
+            rows[row['source']] = row
+        try:
+            written = []
+            if rows and self.update:
+                written = update_rows(self.db, rows, self.debug)
+            elif rows:
+                written = insert_rows(self.db, rows, self.debug, self.source_index)
+            if self.run_id is not None:
+                save_checkpoints(
+                    self.db, self.run_id,
+                    [(url, "done") for url, _ in pending] +
+                    [(url, "error") for url in errors])
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            if self.debug:
+                logger.error(str(e))
+            tqdm.write(Fore.RED +
+                       f"Failed to write {len(pending)} rows to the database.")
+            return [(url, None) for url, _ in pending]
+
+        # only the committed rows are added to the index
+        update_source_index(self.source_index, written)
+        written = {row['source'] for row in written}
+        return [(url, 0 if row['source'] in written else 2)
+                for url, row in pending]
+
+
+def get_existing_ids(db: Session, sources):
+    """ Return a dict mapping the sources already present in the db
+        to their row ids
+    """
+    sources = list(sources)
+    existing = {}
+    for i in range(0, len(sources), IN_CLAUSE_CHUNK):
+        rows = db.execute(
+            select(models.Metadata.id, models.Metadata.source).where(
+                models.Metadata.source.in_(sources[i:i+IN_CLAUSE_CHUNK])))
+        for row_id, source in rows:
+            existing[source] = row_id
+    return existing
+
+
+def insert_rows(db: Session, rows: dict, debug: bool, source_index=None):
+    """ Execute a bulk insert query for the db, skipping the rows which
+        already exist. Returns the inserted rows, without committing
+    """
+    if source_index is not None:
+        existing = {source for source in rows if source in source_index}
+    else:
+        existing = get_existing_ids(db, rows)
+
+    new_rows = [row for source, row in rows.items() if source not in existing]
+    if new_rows:
+        query = insert(models.Metadata.__table__).on_conflict_do_nothing(
+            index_elements=['source'])
+        db.execute(query, new_rows)
+        save_tags(db, get_fic_tags(db, new_rows), replace=False)
         if debug:
-            logger.info("Adding metadata to the database.")
+            logger.info(f"Adding {len(new_rows)} rows to the database.")
         tqdm.write(Fore.GREEN +
-                   "Adding metadata to the database.")
-    else:
-        db.query(models.Metadata).filter(
-            models.Metadata.source == item['source']). \
-            update(
-            {
-                models.Metadata.fichub_id: item['id'],
-                models.Metadata.fic_id: process_extendedMeta(item,'id'),
-                models.Metadata.title: item['title'],
-                models.Metadata.author: item['author'],
-                models.Metadata.author_id: item['authorLocalId'],
-                models.Metadata.author_url: item['authorUrl'],
-                models.Metadata.chapters: item['chapters'],
-                models.Metadata.created: item['created'],
-                models.Metadata.description: item['description'],
-                models.Metadata.rated: process_extendedMeta(item,'rated'),
-                models.Metadata.language: process_extendedMeta(item,'language'),
-                models.Metadata.genre: process_extendedMeta(item,'genres'),
-                models.Metadata.characters: process_extendedMeta(item,'characters'),
-                models.Metadata.reviews: process_extendedMeta(item,'reviews'),
-                models.Metadata.favorites: process_extendedMeta(item,'favorites'),
-                models.Metadata.follows: process_extendedMeta(item,'follows'),
-                models.Metadata.status: item['status'],
-                models.Metadata.words: item['words'],
-                models.Metadata.fandom: process_extendedMeta(item,'raw_fandom'),
-                models.Metadata.fic_last_updated: datetime.fromisoformat(item['updated']).strftime(config['fic_up_time_format']),
-                models.Metadata.db_last_updated: datetime.now().astimezone().strftime(config['db_up_time_format']),
-                models.Metadata.source: item['source']
-            }
-        )
+                   f"Adding {len(new_rows)} rows to the database.")
+
+    if existing:
         if debug:
             logger.info(
-                "Metadata already exists. Overwriting metadata to the database.")
-        tqdm.write(Fore.GREEN +
-                   "Metadata already exists. Overwriting metadata to the database.\n")
+                f"Metadata already exists for {len(existing)} rows. Skipping. Use --force to force-update existing data.")
+        tqdm.write(Fore.RED +
+                   f"Metadata already exists for {len(existing)} rows. Skipping. Use --force to force-update existing data.\n")
 
-    db.commit()
-    return 0, 0  # exit code
+    return new_rows
 
 
-def dump_json(db: Session, input_db, json_file: str, debug: bool):
-    """ Process the sqlite db and dump the metadata as json
+def update_rows(db: Session, rows: dict, debug: bool):
+    """ Execute a bulk upsert query for the db: insert the new rows &
+        overwrite the existing ones. Returns the rows, without committing
     """
+    query = get_upsert_query()
+    db.execute(query, list(rows.values()))
+    save_tags(db, get_fic_tags(db, rows.values()), replace=True)
     if debug:
-        logger.info("Getting all rows from database.")
-    tqdm.write(Fore.GREEN + "Getting all rows from database.")
-    try:
-        all_rows = get_all_rows(db)
-    except OperationalError as e:
-        if debug:
-            logger.info(Fore.RED + str(e))
-        db_not_found_log(debug, input_db)
-        sys.exit(1)
+        logger.info(f"Saving {len(rows)} rows to the database.")
+    tqdm.write(Fore.GREEN +
+               f"Saving {len(rows)} rows to the database.")
+    return list(rows.values())
 
-    sql_to_json(json_file, all_rows, debug)
-    db.commit()
 
-
-def get_all_rows(db: Session):
-    return db.query(models.Metadata).all()
-
-
-def add_fichub_id_column(db: Session, db_backup, debug: bool):
-    """ To add a column AFTER an existing column
+def get_fic_tags(db: Session, rows):
+    """ Map the row ids of the written rows to their tags
     """
+    rows = list(rows)
+    ids = get_existing_ids(db, (row['source'] for row in rows))
+    return {ids[row['source']]: get_tags(row) for row in rows
+            if row['source'] in ids}
 
-    drop_TempFichubMetadata(db)
-    col_exists = False
-    try:
-        col_exists = db.execute(text("SELECT fichub_id from fichub_metadata;"))
-        col_exists = True
-    except OperationalError as e:
-        if debug:
-            logger.error(e)
-        pass
-    if not col_exists:
-        tqdm.write(
-            Fore.GREEN + "Database Schema changes detected! Migrating the database.")
-        # backup the db before migrating the data
-        db_backup("pre.migration")
-
-        if debug:
-            logger.info("Migration: adding fichub_id column")
-        tqdm.write(Fore.GREEN + "Migration: adding fichub_id column")
 
-        db.execute(text("ALTER TABLE fichub_metadata RENAME TO TempFichubMetadata;"))
-        db.execute(text("CREATE TABLE fichub_metadata(id INTEGER NOT NULL, fichub_id VARCHAR(255),title VARCHAR(255), author VARCHAR(255), chapters INTEGER, created VARCHAR(255), description VARCHAR(255), rated VARCHAR(255), language VARCHAR(255), genre VARCHAR(255), characters VARCHAR(255), reviews INTEGER, favs INTEGER, follows INTEGER, status VARCHAR(255), words INTEGER, last_updated VARCHAR(255), source VARCHAR(255), PRIMARY KEY(id));"))
-        db.execute(text("INSERT INTO fichub_metadata (id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status, words, last_updated, source ) SELECT id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status, words,last_updated, source FROM TempFichubMetadata;"))
-        db.execute(text("DROP TABLE TempFichubMetadata;"))
-        db.commit()
+def save_tags(db, fic_tags: dict, replace: bool):
+    """ Write the (kind, name) tags of each fic id to the tag tables. With
+        replace, the old tags of the fics are removed first. Works on a
+        session or a connection & doesnt commit
+    """
+    if replace:
+        fic_ids = list(fic_tags)
+        for i in range(0, len(fic_ids), IN_CLAUSE_CHUNK):
+            db.execute(delete(models.FicTag).where(
+                models.FicTag.fic_id.in_(fic_ids[i:i+IN_CLAUSE_CHUNK])))
+
+    links = [(fic_id, kind, name)
+             for fic_id, tags in fic_tags.items() for kind, name in tags]
+    if not links:
+        return
+    # plain executemany, these are a few rows per fic
+    conn = db.connection() if isinstance(db, Session) else db
+    conn.exec_driver_sql(TAG_INSERT, list({link[1:] for link in links}))
+    conn.exec_driver_sql(FIC_TAG_INSERT, links)
+
+
+def tag_filter(kind: str, name: str):
+    """ Where clause for the metadata rows with a tag, e.g.
+        tag_filter("character", "Harry P.") (case insensitive)
+    """
+    return models.Metadata.id.in_(
+        select(models.FicTag.fic_id).join(
+            models.Tag, models.Tag.id == models.FicTag.tag_id).where(
+            models.Tag.kind == kind, models.Tag.name == name))
 
 
-def add_db_last_updated_column(db: Session, db_backup, debug: bool):
-    """ To add a column AFTER an existing column
+def search_rows(db: Session, match: str, limit: int, offset: int = 0):
+    """ Return the number of fics matching the FTS5 query & a page of
+        them, best match first. Only the matching rows of the index are
+        read, not the whole table
+    """
+    total = db.execute(text(
+        "SELECT COUNT(*) FROM fichub_search WHERE fichub_search MATCH :match;"),
+        {"match": match}).scalar()
+    rows = db.execute(text(
+        "SELECT m.title, m.author, m.fandom, m.words, m.status, m.source FROM fichub_search JOIN fichub_metadata AS m ON m.id = fichub_search.rowid "
+        f"WHERE fichub_search MATCH :match ORDER BY {SEARCH_RANK} LIMIT :limit OFFSET :offset;"),
+        {"match": match, "limit": limit, "offset": offset}).fetchall()
+    return total, rows
+
+
+# the date columns are sorted by their timestamps
+SORT_COLUMNS = {'created': 'created_ts', 'fic_last_updated': 'fic_last_updated_ts',
+                'db_last_updated': 'db_last_updated_ts'}
+
+
+def query_rows(db: Session, columns: list, author: str = None,
+               status: str = None, rated: str = None, min_words: int = None,
+               max_words: int = None, updated_since: datetime = None,
+               tags: list = (), sort: str = None, limit: int = None):
+    """ Stream the requested columns of the rows matching all the filters.
+        `tags` is a list of (kind, name) & `sort` a column name, with a -
+        prefix for descending order
+    """
+    table = models.Metadata.__table__
+    query = select(*(table.c[col] for col in columns))
+    if author is not None:
+        query = query.where(table.c.author == author)
+    if status is not None:
+        query = query.where(table.c.status == status)
+    if rated is not None:
+        query = query.where(table.c.rated == rated)
+    if min_words is not None:
+        query = query.where(table.c.words >= min_words)
+    if max_words is not None:
+        query = query.where(table.c.words <= max_words)
+    for kind, name in tags:
+        query = query.where(tag_filter(kind, name))
+
+    if updated_since is not None:
+        query = query.where(table.c.fic_last_updated_ts >= local_timestamp(updated_since))
+
+    if sort:
+        column = table.c[SORT_COLUMNS.get(sort.lstrip("-"), sort.lstrip("-"))]
+        query = query.order_by(column.desc() if sort.startswith("-") else column)
+    if limit:
+        query = query.limit(limit)
+
+    yield from db.execute(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+
+
+# the stats tracked in the history table
+TRENDING_STATS = ['favorites', 'follows', 'reviews', 'words', 'chapters']
+
+
+def trending_rows(db: Session, stat: str, since_ts: int, limit: int):
+    """ Return the fics whose stat grew the most since the timestamp, as
+        (growth, title, author, stat, source). The deltas are summed in
+        SQL over the window of the history index
+    """
+    history = models.History.__table__
+    table = models.Metadata.__table__
+    growth = func.sum(history.c[stat]).label("growth")
+    top = select(history.c.fic_id, growth).where(
+        history.c.ts >= since_ts).group_by(history.c.fic_id).having(
+        growth > 0).order_by(growth.desc()).limit(limit).subquery()
+    return db.execute(select(
+        top.c.growth, table.c.title, table.c.author, table.c[stat], table.c.source).join_from(
+        top, table, table.c.id == top.c.fic_id).order_by(top.c.growth.desc()))
+
+
+def update_source_index(source_index, rows):
+    """ Add the written rows to the in-memory source index
     """
+    if source_index is not None:
+        for row in rows:
+            source_index.add(
+                row['source'], row['fichub_id'], row['fic_last_updated'])
 
-    drop_TempFichubMetadata(db)
-    col_exists = False
-    try:
-        db.execute(text("SELECT db_last_updated from fichub_metadata;"))
-        col_exists = True
-    except OperationalError as e:
-        if debug:
-            logger.error(e)
-        pass
-    if not col_exists:
-        tqdm.write(
-            Fore.GREEN + "Database Schema changes detected! Migrating the database.")
-        # backup the db before migrating the data
-        db_backup("pre.migration")
 
-        if debug:
-            logger.info("Migration: adding db_last_updated column")
-        tqdm.write(Fore.GREEN + "Migration: adding db_last_updated column")
+def get_upsert_query():
+    """ INSERT ... ON CONFLICT(source) DO UPDATE for the metadata table
+    """
+    table = models.Metadata.__table__
+    query = insert(table)
+    return query.on_conflict_do_update(
+        index_elements=['source'],
+        set_={col.name: query.excluded[col.name] for col in table.columns
+              if col.name not in ('id', 'source')})
 
-        db.execute(text("ALTER TABLE fichub_metadata RENAME TO TempFichubMetadata;"))
-        db.execute(text("CREATE TABLE fichub_metadata(id INTEGER NOT NULL, fichub_id VARCHAR(255), title VARCHAR(255), author VARCHAR(255), chapters INTEGER, created VARCHAR(255), description VARCHAR(255), rated VARCHAR(255), language VARCHAR(255), genre VARCHAR(255), characters VARCHAR(255), reviews INTEGER, favs INTEGER, follows INTEGER, status VARCHAR(255), words INTEGER, fic_last_updated VARCHAR(255), db_last_updated VARCHAR(255), source VARCHAR(255), PRIMARY KEY(id));"))
-        db.execute(text("INSERT INTO fichub_metadata (id, fichub_id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status,  words, fic_last_updated, source ) SELECT id, fichub_id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status, words, last_updated, source FROM TempFichubMetadata;"))
-        db.execute(text("DROP TABLE TempFichubMetadata;"))
-        db.commit()
 
-def add_rawExtendedMeta_columns(db: Session, db_backup, debug: bool):
-    """ To add fic_id, author_id, author_url, fandom columns
+def save_checkpoints(db: Session, run_id: int, states: list):
+    """ Upsert the (url, state) checkpoints of a run, counting the attempts.
+        Doesnt commit, the caller commits it along with the data
     """
-    cols_list = ['fic_id','author_id','author_url','fandom']
-    for col in cols_list:
-        col_exists = False
-        try:
-            db.execute(text(f"SELECT {col} from fichub_metadata;"))
-            col_exists = True
-        except OperationalError as e:
-            if debug:
-                logger.error(e)
-            pass
-        if not col_exists:
-            tqdm.write(
-                Fore.GREEN + f"{col} column not found! Migrating the database.")
-            # backup the db before migrating the data
-            db_backup("pre.migration")
-
-            if debug:
-                logger.info(f"Migration: adding {col} column")
-            tqdm.write(Fore.GREEN + f"Migration: adding {col} column")
-
-            db.execute(text(f"ALTER TABLE fichub_metadata ADD {col} TEXT DEFAULT '';"))
+    if not states:
+        return
+    table = models.Checkpoint.__table__
+    updated = datetime.now().astimezone().isoformat(timespec="seconds")
+    query = insert(table)
+    query = query.on_conflict_do_update(
+        index_elements=['run_id', 'url'],
+        set_={'state': query.excluded.state, 'updated': query.excluded.updated,
+              'attempts': table.c.attempts + 1})
+    db.execute(query, [{'run_id': run_id, 'url': url, 'state': state,
+                        'attempts': 1, 'updated': updated}
+                       for url, state in dict(states).items()])
+
+
+def start_run(db: Session, kind: str, input: str, resume: bool):
+    """ Return the run id & the urls already done by it. With resume, the
+        last unfinished run of the same kind & input is continued,
+        else a new run is started
+    """
+    run = None
+    if resume:
+        run = db.execute(
+            select(models.Run).where(
+                models.Run.kind == kind, models.Run.input == input,
+                models.Run.finished.is_(None)).order_by(
+                models.Run.id.desc())).scalars().first()
+
+    if run is None:
+        # the older unfinished runs of the input cant be resumed anymore
+        delete_runs(db, select(models.Run.id).where(
+            models.Run.kind == kind, models.Run.input == input,
+            models.Run.finished.is_(None)))
+        run = models.Run(kind=kind, input=input,
+                         started=datetime.now().astimezone().isoformat(timespec="seconds"))
+        db.add(run)
         db.commit()
+        return run.id, set(), False
 
+    done = set(db.execute(
+        select(models.Checkpoint.url).where(
+            models.Checkpoint.run_id == run.id,
+            models.Checkpoint.state == "done")).scalars())
+    return run.id, done, True
 
 
-def rename_favs_column(db: Session, db_backup, debug: bool):
-    """ To rename favs column to favorites
+def finish_run(db: Session, run_id: int):
+    """ Delete the run & its checkpoints once it is complete, the errors
+        are in the output & the changelog
     """
+    delete_runs(db, [run_id])
+    db.commit()
 
-    col_exists = False
+
+def delete_runs(db: Session, run_ids):
+    """ Delete the runs & their checkpoints, run_ids is a list of ids or
+        a select of them
+    """
+    db.execute(delete(models.Checkpoint).where(
+        models.Checkpoint.run_id.in_(run_ids)))
+    db.execute(delete(models.Run).where(models.Run.id.in_(run_ids)))
+
+
+def dump_db(db: Session, input_db, out_file: str, export_format: str,
+            debug: bool, since: datetime = None):
+    """ Stream the rows of the sqlite db to a file in the export format.
+        If `since` is given, only the rows updated after it are exported.
+    """
+    if debug:
+        logger.info("Getting all rows from database.")
+    tqdm.write(Fore.GREEN + "Getting all rows from database.")
+    table = models.Metadata.__table__
+    where = [] if since is None else [
+        table.c.db_last_updated_ts >= local_timestamp(since)]
     try:
-        db.execute(text("SELECT favorites from fichub_metadata;"))
-        col_exists = True
+        total = db.execute(select(func.count()).select_from(table).where(*where)).scalar()
     except OperationalError as e:
         if debug:
-            logger.error(e)
-        pass
-    if not col_exists:
-        tqdm.write(
-            Fore.GREEN + "Database Schema changes detected! Migrating the database.")
-        # backup the db before migrating the data
-        db_backup("pre.migration")
+            logger.info(Fore.RED + str(e))
+        db_not_found_log(debug, input_db)
+        sys.exit(1)
 
-        if debug:
-            logger.info("Migration: renaming favs column to favorites")
-        tqdm.write(Fore.GREEN + "Migration: renaming favs column to favorites")
+    if total:
+        rows = db.execute(select(*table.columns).where(*where).execution_options(
+            yield_per=EXPORT_CHUNK_SIZE))
+        export_rows(out_file, export_format, list(table.columns.keys()),
+                    rows, total, debug)
+    db.commit()
 
-        db.execute(text("ALTER TABLE fichub_metadata RENAME COLUMN favs TO favorites;"))
-        db.commit()
 
+def get_refresh_info(db: Session):
+    """ Stream the columns needed to decide if a row is due for an
+        incremental update
+    """
+    for row in db.execute(select(
+            models.Metadata.source, models.Metadata.status,
+            models.Metadata.fic_last_updated_ts, models.Metadata.db_last_updated_ts).where(
+            models.Metadata.source.isnot(None))):
+        yield row
 
-def drop_TempFichubMetadata(db: Session):
-    try:
-        db.execute(text("DROP TABLE TempFichubMetadata;"))
-    except OperationalError:
-        pass
+
+def get_all_sources(db: Session):
+    """ Stream the source column without loading the ORM objects
+    """
+    for source, in db.execute(select(models.Metadata.source).where(
+            models.Metadata.source.isnot(None))):
+        yield source
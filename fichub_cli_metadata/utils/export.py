@@ -0,0 +1,168 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+import sys
+from contextlib import nullcontext
+from itertools import islice
+from tqdm import tqdm
+from colorama import Fore
+from loguru import logger
+
+
+def open_output(out_file: str, **kwargs):
+    """ Open the output file for writing, "-" is stdout
+    """
+    if out_file == "-":
+        return nullcontext(sys.stdout)
+    return open(out_file, 'w', **kwargs)
+
+
+def write_json(out_file: str, columns: list, rows):
+    """ Write the rows as a json array, one element at a time.
+        The output is identical to json.dump() on a list of dicts.
+    """
+    with open_output(out_file) as outfile:
+        outfile.write("[")
+        for i, row in enumerate(rows):
+            if i:
+                outfile.write(", ")
+            outfile.write(json.dumps(dict(zip(columns, row))))
+        outfile.write("]")
+
+
+def write_ndjson(out_file: str, columns: list, rows):
+    """ Write the rows as newline delimited json, one object per line
+    """
+    with open_output(out_file) as outfile:
+        for row in rows:
+            outfile.write(json.dumps(dict(zip(columns, row))) + "\n")
+
+
+def write_csv(out_file: str, columns: list, rows):
+    """ Write the rows as csv with a header line
+    """
+    with open_output(out_file, newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def write_table(out_file: str, columns: list, rows, sample_size: int = 100,
+                max_width: int = 40):
+    """ Write the rows as an aligned text table. The column widths are
+        taken from the first `sample_size` rows, so the rows can be
+        streamed; longer values are cut
+    """
+    rows = iter(rows)
+    sample = list(islice(rows, sample_size))
+    widths = [min(max_width, max([len(col)] + [len(str(row[i])) for row in sample]))
+              for i, col in enumerate(columns)]
+
+    def line(values):
+        cells = []
+        for value, width in zip(values, widths):
+            value = "" if value is None else str(value).replace("\n", " ")
+            if len(value) > width:
+                value = value[:width - 3] + "..." if width > 3 else value[:width]
+            cells.append(value.ljust(width))
+        return "  ".join(cells).rstrip() + "\n"
+
+    with open_output(out_file) as outfile:
+        outfile.write(line(columns))
+        outfile.write(line("-" * width for width in widths))
+        for row in sample:
+            outfile.write(line(row))
+        for row in rows:
+            outfile.write(line(row))
+
+
+# columns stored as proper integers in the parquet file, the API can
+# return some of these stats as strings e.g. "1,234". The ids given by
+# the sites (fic_id, author_id) arent always numbers e.g. AO3 usernames,
+# so they are kept as strings
+PARQUET_INT_COLUMNS = {'id', 'chapters', 'reviews', 'favorites', 'follows',
+                       'words', 'created_ts', 'fic_last_updated_ts',
+                       'db_last_updated_ts'}
+
+
+def to_int(value):
+    """ Convert a stat to int, None if it isnt a number
+    """
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(str(value).replace(",", "").strip())
+    except ValueError:
+        return None
+
+
+def write_parquet(out_file: str, columns: list, rows, chunk_size: int = 10000):
+    """ Write the rows as a parquet file, one row group per chunk
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        tqdm.write(Fore.RED + "Parquet export needs pyarrow. Install it using: " +
+                   "pip install -U fichub-cli-metadata[parquet]")
+        sys.exit(1)
+
+    schema = pa.schema(
+        [(col, pa.int64() if col in PARQUET_INT_COLUMNS else pa.string())
+         for col in columns])
+    converters = [to_int if col in PARQUET_INT_COLUMNS else
+                  lambda value: None if value is None else str(value)
+                  for col in columns]
+
+    rows = iter(rows)
+    with pq.ParquetWriter(out_file, schema) as writer:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            data = {col: [convert(row[i]) for row in chunk]
+                    for i, (col, convert) in enumerate(zip(columns, converters))}
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+
+EXPORT_FORMATS = {
+    "json": write_json,
+    "ndjson": write_ndjson,
+    "csv": write_csv,
+    "parquet": write_parquet,
+}
+
+
+# output formats of the query subcommand
+QUERY_FORMATS = {
+    "table": write_table,
+    "ndjson": write_ndjson,
+    "csv": write_csv,
+    "json": write_json,
+}
+
+
+def export_rows(out_file: str, export_format: str, columns: list, rows,
+                total: int, debug: bool):
+    """ Stream the rows from the db query to the output file in the
+        given format, with constant memory
+    """
+    if debug:
+        logger.info(f"Saving {out_file}")
+    tqdm.write(Fore.GREEN + f"Saving {out_file}")
+
+    rows = tqdm(rows, total=total, ascii=False, unit="row")
+    EXPORT_FORMATS[export_format](out_file, columns, rows)
@@ -12,20 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from . import models, crud
+from . import models, crud, migrations
 import os
 import sys
-import shutil
+import glob
+import json
+import queue
+import sqlite3
+import threading
 from datetime import datetime
 import time
 from tqdm import tqdm
 import typer
 from colorama import Fore, Style
 from loguru import logger
-from rich.console import Console
 import re
 import requests
-from bs4 import BeautifulSoup
 import traceback
 from platformdirs import PlatformDirs
 
@@ -36,21 +38,33 @@ from fichub_cli.utils.fichub import FicHub
 from .logging import meta_fetched_log, db_not_found_log
 
 from fichub_cli_metadata import __version__ as plugin_version
-from fichub_cli.utils.processing import check_url, save_data, \
-    urls_preprocessing, build_changelog, output_log_cleanup
+from fichub_cli.utils.processing import check_url, save_data
 from fichub_cli.utils.logging import download_processing_log, verbose_log
-from .processing import init_database, get_db, object_as_dict,\
-    prompt_user_contact
+from .source_index import SourceIndex
+from .changelog import Changelog
+from .url_input import is_input_file, get_db_name, open_input, count_lines, \
+    read_urls
+from .extract import parse_listing, page_url
+from .ratelimit import RateLimiter, RETRY_STATUSES, backoff_delay, \
+    pooled_session
+from .cache import MetaCache
+from .export import EXPORT_FORMATS, QUERY_FORMATS
+from .processing import init_database, get_db, prompt_user_contact, DB_PROFILES,\
+    fetch_concurrently, load_config, needs_refresh, match_query, TAG_COLUMNS
     
 
 bar_format = "{l_bar}{bar}| {n_fmt}/{total_fmt}, {rate_fmt}{postfix}, ETA: {remaining}"
 app_dirs = PlatformDirs("fichub_cli", "fichub")
-console = Console()
 
 
 class FetchData:
     def __init__(self, out_dir="", input_db="", update_db=False, format_type=None,
-                 export_db=False, verbose=False, debug=False, changelog=False, automated=False, force=False):
+                 export_db=False, verbose=False, debug=False, changelog=False, automated=False, force=False,
+                 workers=4, batch_size=100, incremental=False, complete_ttl=90,
+                 export_format="json", export_since=None, no_backup=False,
+                 keep_backups=0, db_profile="fast", resume=False,
+                 rate_limits=None, max_retries=3, cache_ttl=24, cache_size=256,
+                 no_cache=False, offline=False, cache_dir=None):
         self.out_dir = out_dir
         self.format_type = format_type
         self.input_db = input_db
@@ -58,34 +72,91 @@ class FetchData:
         self.export_db = export_db
         self.verbose = verbose
         self.force = force
-        self.changelog = changelog
+        self.save_changelog = changelog
+        self.changelog = Changelog()
         self.debug = debug
         self.automated = automated
+        self.workers = workers
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.complete_ttl = complete_ttl
+        self.export_format = export_format
+        self.export_since = export_since
+        self.no_backup = no_backup
+        self.keep_backups = keep_backups
+        self.backup_done = False
+        self.db_profile = db_profile
+        self.resume = resume
+        # nothing to retry when the metadata only comes from the cache
+        self.max_retries = 0 if offline else max_retries
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.no_cache = no_cache
+        self.offline = offline
+        self.cache_dir = cache_dir or os.path.join(
+            app_dirs.user_cache_dir, "fichub_cli_metadata")
+        self.cache = None
+        self.limiter = RateLimiter(rate_limits)
+        self.http = pooled_session(self.limiter, workers)
+        self.engine = None
         self.exit_status = 0
+        self._config = None
+
+    @property
+    def config(self):
+        """ The CLI config, only loaded by the commands which need it
+        """
+        if self._config is None:
+            self._config = load_config(self.debug)
+        return self._config
 
     def save_metadata(self, input: str):
         """ Store the metadata in the sqlite database
         """
         db_name = "fichub_metadata"
-        supported_url = None
+        self.changelog = Changelog(self.out_dir, self.save_changelog)
 
-        # check if the input is a file
-        if os.path.isfile(input):
+        # check if the input is a file, "-" for stdin
+        if is_input_file(input):
             if self.debug:
                 logger.info(f"Input file: {input}")
-            # get the tail
-            _, file_name = os.path.split(input)
-            db_name = os.path.splitext(file_name)[0]
-            with open(input, "r") as f:
-                urls_input = f.read().splitlines()
+            db_name = get_db_name(input)
+            total = count_lines(input)
+            input_file = open_input(input)
+            run_input = "-" if input == "-" else os.path.abspath(input)
 
         else:
             if self.debug:
                 logger.info("Input is an URL")
-            urls_input = [input]
+            total = 1
+            input_file = [input]
+            run_input = input
+
+        self.create_database(db_name)
+
+        # if force=True, dont insert, update instead
+        done_urls = self.init_writer(
+            update=self.force, kind="save", run_input=run_input,
+            resume_args=f'-i "{run_input}"')
 
-        urls, urls_input_dedup = urls_preprocessing(urls_input, self.debug)
+        # the input is read lazily while the urls are being fetched
+        urls = (url for url in read_urls(input_file, self.changelog, self.debug)
+                if url not in done_urls)
 
+        try:
+            self.save_urls(urls, total)
+        finally:
+            if hasattr(input_file, "close"):
+                input_file.close()
+            self.input_report()
+            self.throttle_report()
+            self.close_cache()
+            self.changelog.save()
+
+    def create_database(self, db_name: str):
+        """ Open the --input-db or create a new timestamped db, migrated
+            & backed up before any changes
+        """
         if not self.input_db:  # create db if no existing db is given
             timestamp = datetime.now().strftime("%Y-%m-%d T%H%M%S")
             self.db_file = os.path.join(
@@ -93,121 +164,270 @@ class FetchData:
         else:
             self.db_file = self.input_db
 
-        self.engine, self.SessionLocal = init_database(self.db_file)
-        self.db: Session = next(get_db(self.SessionLocal))
+        # a db created by this run has nothing to backup
+        new_db = not os.path.isfile(self.db_file)
+        self.open_database()
 
-        # if a db is given as input, run migrations before any operations
-        if self.input_db:
-            # run db migrations
-            self.run_migrations()
+        # run db migrations before any operations
+        self.run_migrations()
 
-        try:
+        if not new_db:
             # backup the db before changing the data
             self.db_backup("pre.update")
-        except FileNotFoundError:
-            # when run 1st time, no db exists
-            pass
-
-        downloaded_urls, no_updates_urls, err_urls = [], [], []
 
+    def save_urls(self, urls, total: int = None):
+        """ Fetch & save the metadata for the urls, which can be streamed
+            while they are being read or discovered. `total` is an upper
+            bound for the progress bar, None if it isnt known
+        """
         try:
-            if urls:
-                with tqdm(total=len(urls), ascii=False,
-                          unit="url", bar_format=bar_format) as pbar:
+            with tqdm(total=total, ascii=False,
+                      unit="url", bar_format=bar_format) as pbar:
 
+                def urls_to_fetch():
+                    """ Filter out the unsupported & existing urls before
+                        they are handed to the fetch workers
+                    """
                     for url in urls:
-                        self.url_exit_status = 0
                         download_processing_log(self.debug, url)
                         supported_url, self.exit_status = check_url(
                             url, self.debug, self.exit_status)
 
-                        if supported_url:
-                            # check if url exists in db
-                            if self.input_db:
-                                exists = self.db.query(models.Metadata).filter(
-                                    models.Metadata.source == url).first()
-                            else:
-                                exists = None
-
-                            if not exists or self.force:
-                                fic = FicHub(self.debug, self.automated,
-                                             self.exit_status)
-                                fic.get_fic_metadata(url, self.format_type)
-
-                                if self.verbose:
-                                    verbose_log(self.debug, fic)
-
-                                try:
-                                    # if --download-ebook flag used
-                                    if self.format_type:
-                                        self.exit_status, self.url_exit_status = save_data(
-                                            self.out_dir, fic.files, self.debug, self.force,
-                                            self.exit_status, self.automated)
-
-                                    # save the data to db
-                                    if fic.files["meta"]:
-                                        meta_fetched_log(self.debug, url)
-                                        self.save_to_db(fic.files["meta"])
-
-                                        with open("output.log", "a") as file:
-                                            file.write(f"{url}\n")
-
-                                        # update the exit status
-                                        self.exit_status = fic.exit_status
-                                        if self.url_exit_status == 0:
-                                            downloaded_urls.append(url)
-                                        elif self.url_exit_status == 2:
-                                            # already exists
-                                            err_urls.append(url)
-                                        else:
-                                            no_updates_urls.append(url)
-
-                                    else:
-                                        self.exit_status = 1
-                                        supported_url = None
-                                        err_urls.append(url)
-                                    pbar.update(1)
-
-                                # if fic doesnt exist or the data is not fetched by the API yet
-                                except Exception as e:
-                                    if self.debug:
-                                        logger.error(str(traceback.format_exc()))
-                                    self.exit_status = 1
-                                    err_urls.append(url)
-                                    pbar.update(1)
-                                    pass  # skip the unsupported url
-                            else:
-                                self.exit_status = 2
-                                supported_url = None
-                                err_urls.append(url)  # already exists
-                                pbar.update(1)
-                                if self.debug:
-                                    logger.info(
-                                        "Metadata already exists. Skipping. Use --force to force-update existing data.")
-                                tqdm.write(Fore.RED +
-                                           "Metadata already exists. Skipping. Use --force to force-update existing data.\n")
-
-                    if self.exit_status == 0:
-                        tqdm.write(Fore.GREEN +
-                                   "\nMetadata saved as " + Fore.BLUE +
-                                   f"{os.path.abspath(self.db_file)}"+Style.RESET_ALL +
-                                   Style.RESET_ALL)
-            else:
-                typer.echo(Fore.RED +
-                           "No new urls found! If output.log exists, please clear it.")
+                        if not supported_url:
+                            continue
+
+                        # check if url exists in db
+                        if url not in self.source_index or self.force:
+                            yield url
+                        else:
+                            self.exit_status = 2
+                            self.changelog.add("errors", url)  # already exists
+                            pbar.update(1)
+                            if self.debug:
+                                logger.info(
+                                    "Metadata already exists. Skipping. Use --force to force-update existing data.")
+                            tqdm.write(Fore.RED +
+                                       "Metadata already exists. Skipping. Use --force to force-update existing data.\n")
+
+                for url, future in self.fetch_with_retries(urls_to_fetch()):
+                    try:
+                        fic = future.result()
+
+                        # queue the data to be saved to the db
+                        if fic.files["meta"]:
+                            meta_fetched_log(self.debug, url)
+                            self.record_results(
+                                self.writer.add(url, fic.files["meta"]))
+
+                            # update the exit status
+                            if fic.exit_status:
+                                self.exit_status = fic.exit_status
+
+                        else:
+                            self.record_error(url)
+                        pbar.update(1)
+
+                    # if fic doesnt exist or the data is not fetched by the API yet
+                    except Exception:
+                        if self.debug:
+                            logger.error(str(traceback.format_exc()))
+                        self.record_error(url)
+                        pbar.update(1)
+                        pass  # skip the unsupported url
+
+                self.record_results(self.writer.flush())
+                crud.finish_run(self.db, self.run_id)
+
+                # the total was an upper bound, before removing the duplicates
+                pbar.total = pbar.n
+                pbar.refresh()
+
+                if pbar.n == 0:
+                    typer.echo(Fore.RED +
+                               "No new urls found! If output.log exists, please clear it.")
+                elif self.exit_status == 0:
+                    tqdm.write(Fore.GREEN +
+                               "\nMetadata saved as " + Fore.BLUE +
+                               f"{os.path.abspath(self.db_file)}"+Style.RESET_ALL +
+                               Style.RESET_ALL)
         except KeyboardInterrupt:
-            output_log_cleanup(app_dirs)
+            # save the fetched data before exiting
+            self.record_results(self.writer.flush())
+            self.interrupted_log()
             sys.exit(2)
 
-        finally:
-            if self.changelog:
-                build_changelog(urls_input, urls_input_dedup, urls, downloaded_urls,
-                                err_urls, no_updates_urls, self.out_dir)
+    def fetch_fic(self, url: str):
+        """ Fetch the metadata (& the ebooks if --download-ebook is used)
+            for an url. Runs in the worker threads, so it must not touch
+            the db session
+        """
+        fic = FicHub(self.debug, self.automated, self.exit_status)
+        # reuse the pooled connections of the run
+        fic.http = self.http
+
+        # the ebook download urls are not cached, always fetch them
+        cached = None
+        if self.cache is not None and not self.format_type:
+            cached = self.cache.get(url)
+
+        # --update-db & --force refresh the data, so they only revalidate
+        # the cache
+        if cached is not None and (self.offline or (
+                not (self.update_db or self.force) and self.cache.is_fresh(cached))):
+            self.cache.hit()
+            self.use_cached(fic, cached)
+
+        elif self.offline:
+            if self.debug:
+                logger.error(f"Metadata not found in the cache: {url}")
+            fic.status_code = None
+
+        else:
+            self.fetch_meta(fic, url, cached)
+
+        if self.verbose:
+            verbose_log(self.debug, fic)
+
+        # if --download-ebook flag used
+        if self.format_type:
+            save_data(self.out_dir, fic.files, self.debug, self.force,
+                      self.exit_status, self.automated)
+
+        return fic
+
+    def fetch_meta(self, fic, url: str, cached=None):
+        """ Fetch the metadata from the API & cache it. A stale cache entry
+            is revalidated with its ETag/Last-Modified, if the response had
+            them
+        """
+        if cached is not None and (cached.etag or cached.last_modified):
+            fic.headers = dict(fic.headers)
+            if cached.etag:
+                fic.headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                fic.headers["If-Modified-Since"] = cached.last_modified
+
+        self.limiter.reset_status()
+        try:
+            fic.get_fic_metadata(url, self.format_type)
+        except ValueError:
+            # a 304 Not Modified response has no json body
+            if cached is None or self.limiter.last_status != 304:
+                raise
+            self.cache.touch(url)
+            self.cache.hit(revalidated=True)
+            self.use_cached(fic, cached)
+            return
+        fic.status_code = self.limiter.last_status
+
+        meta = fic.files.get("meta")
+        if self.cache is not None and meta:
+            etag, last_modified = self.limiter.last_validators
+            # also cached by the source url, which --update-db uses
+            for key in {url, meta.get("source") or url}:
+                self.cache.put(key, meta, etag, last_modified)
+
+    def use_cached(self, fic, cached):
+        fic.response = {"meta": cached.meta}
+        fic.files["meta"] = cached.meta
+        fic.status_code = 200
+
+    def open_cache(self):
+        if self.no_cache or self.cache is not None:
+            return
+        if self.debug:
+            logger.info(f"Opening the metadata cache in '{self.cache_dir}'")
+        self.cache = MetaCache(self.cache_dir, self.cache_ttl * 60 * 60,
+                               self.cache_size * 1024 * 1024)
+
+    def close_cache(self):
+        """ Show the cache hits & evict the old entries
+        """
+        if self.cache is None:
+            return
+        if self.cache.hits:
+            if self.debug:
+                logger.info(
+                    f"Metadata cache: {self.cache.hits} hits, {self.cache.revalidated} revalidated")
+            tqdm.write(Fore.BLUE +
+                       f"Metadata cache: {self.cache.hits} hits, {self.cache.revalidated} revalidated")
+        self.cache.close()
+        self.cache = None
+
+    def fetch_with_retries(self, urls):
+        """ Fetch the urls concurrently, yielding (url, future) pairs. The
+            urls which failed with a transient error are queued & retried
+            after the rest, up to --max-retries times with a jittered
+            backoff, so they dont stall the pipeline
+        """
+        retries = []
+        for url, future in fetch_concurrently(self.fetch_fic, urls, self.workers):
+            if self.max_retries and self.should_retry(future):
+                retries.append(url)
+            else:
+                yield url, future
 
-    def save_to_db(self, item):
-        """ Create the db and execute insert or update crud
-            repectively
+        for attempt in range(1, self.max_retries + 1):
+            if not retries:
+                break
+            delay = backoff_delay(attempt)
+            if self.debug:
+                logger.info(
+                    f"Retrying {len(retries)} failed urls in {delay:.0f}s (attempt {attempt}/{self.max_retries})")
+            tqdm.write(Fore.YELLOW +
+                       f"Retrying {len(retries)} failed urls in {delay:.0f}s (attempt {attempt}/{self.max_retries})")
+            time.sleep(delay)
+
+            urls, retries = retries, []
+            for url, future in fetch_concurrently(self.fetch_fic, urls, self.workers):
+                if attempt < self.max_retries and self.should_retry(future):
+                    retries.append(url)
+                else:
+                    yield url, future
+
+    def should_retry(self, future):
+        """ Check if the fetch failed with a transient error: a network
+            error, an invalid response or a throttled/5xx response. Other
+            errors are bugs, which wouldnt go away by retrying
         """
+        err = future.exception()
+        if err is not None:
+            return isinstance(err, (requests.exceptions.RequestException,
+                                    json.JSONDecodeError))
+        fic = future.result()
+        return not fic.files.get("meta") and \
+            (fic.status_code is None or fic.status_code in RETRY_STATUSES)
+
+    def input_report(self):
+        """ Show the url counts of the input, once it has been read
+        """
+        counts = self.changelog.counts
+        for message in (f"URLs found: {counts['input']}",
+                        f"After removing duplicates, total URLs: {counts['dedup']}",
+                        f"After comparing with output.log, total URLs: {counts['urls']}"):
+            if self.debug:
+                logger.info(message)
+            tqdm.write(Fore.BLUE + message)
+
+    def throttle_report(self):
+        """ Show the time spent waiting for the rate limiter
+        """
+        if not self.limiter.throttled_time and not self.limiter.throttled_responses:
+            return
+        if self.debug:
+            logger.info(
+                f"Rate limited: waited {self.limiter.throttled_time:.1f}s, {self.limiter.throttled_responses} throttled responses")
+        tqdm.write(Fore.YELLOW +
+                   f"Rate limited: waited {self.limiter.throttled_time:.1f}s, {self.limiter.throttled_responses} throttled responses")
+
+    def init_writer(self, update: bool, kind: str, run_input: str,
+                    resume_args: str):
+        """ Create the db tables & the batch writer which executes the
+            insert or update crud respectively. Starts (or with --resume,
+            continues) a run & returns the urls it already finished.
+            resume_args are the options which select the run's input
+        """
+        self.resume_args = resume_args
         try:
             models.Base.metadata.create_all(bind=self.engine)
         except OperationalError as e:
@@ -216,30 +436,74 @@ class FetchData:
             db_not_found_log(self.debug, self.db_file)
             sys.exit(1)
 
-        # if force=True, dont insert, skip to else & update instead
-        if not self.update_db and not self.force:
-            self.exit_status, self.url_exit_status = crud.insert_data(
-                self.db, item, self.debug)
+        self.run_id, done_urls, resumed = crud.start_run(
+            self.db, kind, run_input, self.resume)
+        if resumed:
+            if self.debug:
+                logger.info(
+                    f"Resuming run {self.run_id}: skipping {len(done_urls)} urls which are already done.")
+            tqdm.write(Fore.GREEN +
+                       f"Resuming run {self.run_id}: skipping {len(done_urls)} urls which are already done.")
+        elif self.resume:
+            tqdm.write(Fore.YELLOW +
+                       "No unfinished run found to resume. Starting a new run.")
+
+        self.open_cache()
+        self.source_index = SourceIndex(self.db, self.debug)
+        self.writer = crud.BatchWriter(
+            self.db, self.config, update, self.debug, batch_size=self.batch_size,
+            source_index=self.source_index, run_id=self.run_id)
+        return done_urls
+
+    def interrupted_log(self):
+        """ Show the command which continues the interrupted run
+        """
+        db_file = os.path.abspath(self.db_file)
+        command = f'fichub_cli metadata {self.resume_args} --input-db "{db_file}" --resume'
+        if self.force:
+            command += " --force"
+        if self.debug:
+            logger.info(f"Interrupted! The fetched data is saved in '{db_file}'")
+        tqdm.write(Fore.YELLOW +
+                   f"Interrupted! The fetched data is saved in '{db_file}'. " +
+                   "To continue this run, use:\n" + Style.RESET_ALL + command)
 
-        elif self.update_db and not self.input_db == "" or self.force:
-            self.exit_status, self.url_exit_status = crud.update_data(
-                self.db, item, self.debug)
+    def record_error(self, url: str):
+        """ Log an url which could not be fetched & checkpoint it
+        """
+        self.exit_status = 1
+        self.changelog.add("errors", url)
+        self.writer.add_error(url)
+
+    def record_results(self, results):
+        """ Log the urls whose rows were written by the batch writer.
+            Their checkpoints are already saved in the same transaction
+        """
+        for url, url_exit_status in results:
+            if url_exit_status is None:
+                # the batch could not be written to the db
+                self.exit_status = 1
+                self.changelog.add("errors", url)
+            elif url_exit_status == 0:
+                self.changelog.add("downloaded", url)
+            elif url_exit_status == 2:
+                # already exists
+                self.changelog.add("errors", url)
+            else:
+                self.changelog.add("no_updates", url)
 
     def update_metadata(self):
         """ Update the metadata found in the sqlite database
         """
         if os.path.isfile(self.input_db):
             self.db_file = self.input_db
-            self.engine, self.SessionLocal = init_database(self.db_file)
+            self.open_database()
         else:
             db_not_found_log(self.debug, self.input_db)
             sys.exit(1)
 
-        self.db: Session = next(get_db(self.SessionLocal))
-        # if a db is given as input, run migrations before any operations
-        if self.input_db:
-            # run db migrations
-            self.run_migrations()
+        # run db migrations before any operations
+        self.run_migrations()
 
         # backup the db before changing the data
         self.db_backup("pre.update")
@@ -247,244 +511,535 @@ class FetchData:
             logger.info("Getting all rows from database.")
         tqdm.write(Fore.GREEN + "Getting all rows from database.")
         try:
-            all_rows = crud.get_all_rows(self.db)
+            # get the urls from the db
+            if self.incremental:
+                urls_input, skipped = [], 0
+                for source, status, fic_last_updated_ts, db_last_updated_ts in \
+                        crud.get_refresh_info(self.db):
+                    if needs_refresh(status, fic_last_updated_ts,
+                                     db_last_updated_ts, self.complete_ttl):
+                        urls_input.append(source)
+                    else:
+                        skipped += 1
+            else:
+                urls_input = list(crud.get_all_sources(self.db))
         except OperationalError as e:
             if self.debug:
                 logger.info(Fore.RED + str(e))
             db_not_found_log(self.debug, self.db_file)
             sys.exit(1)
 
-        # get the urls from the db
-        urls_input = []
-        for row in all_rows:
-            row_dict = object_as_dict(row)
-            urls_input.append(row_dict['source'])
-
-        try:
-            urls, _ = urls_preprocessing(urls_input, self.debug)
-        # if output.log doesnt exist, when run 1st time
-        except FileNotFoundError  as e:
+        if self.incremental:
             if self.debug:
-                logger.error(str(traceback.format_exc()))
-            urls = urls_input
-
-        downloaded_urls, no_updates_urls, err_urls = [], [], []
+                logger.info(
+                    f"Incremental update: skipping {skipped} of {skipped + len(urls_input)} fics unchanged since the last fetch.")
+            tqdm.write(Fore.GREEN +
+                       f"Incremental update: skipping {skipped} of {skipped + len(urls_input)} fics unchanged since the last fetch.")
+
+        self.changelog = Changelog(self.out_dir, self.save_changelog)
+        done_urls = self.init_writer(
+            update=True, kind="update", run_input=os.path.abspath(self.db_file),
+            resume_args="--update-db")
+        urls = [url for url in read_urls(urls_input, self.changelog, self.debug)
+                if url not in done_urls]
+        del urls_input
+        self.input_report()
 
         try:
             with tqdm(total=len(urls), ascii=False,
                       unit="url", bar_format=bar_format) as pbar:
 
-                for url in urls:
-                    self.url_exit_status = 0
-                    fic = FicHub(self.debug, self.automated,
-                                 self.exit_status)
-                    fic.get_fic_metadata(url, self.format_type)
-
-                    if self.verbose:
-                        verbose_log(self.debug, fic)
-
+                for url, future in self.fetch_with_retries(urls):
                     try:
-                        # if --download-ebook flag used
-                        if self.format_type:
-                            self.exit_status, self.url_exit_status = save_data(
-                               self.out_dir, fic.files, self.debug, self.force,
-                                self.exit_status, self.automated)
+                        fic = future.result()
 
-                        # update the metadata
+                        # queue the metadata to be updated
                         if fic.files["meta"]:
                             meta_fetched_log(self.debug, url)
-                            self.exit_status, self.url_exit_status = crud.update_data(
-                                self.db, fic.files["meta"], self.debug)
-
-                            with open("output.log", "a") as file:
-                                file.write(f"{url}\n")
-
-                            if self.url_exit_status == 0:
-                                downloaded_urls.append(url)
-                            elif self.url_exit_status == 2:
-                                # already exists
-                                err_urls.append(url)
-                            else:
-                                no_updates_urls.append(url)
+                            self.record_results(
+                                self.writer.add(url, fic.files["meta"]))
                         else:
-                            self.exit_status = 1
-                            err_urls.append(url)
+                            self.record_error(url)
 
                         pbar.update(1)
 
                     # if fic doesnt exist or the data is not fetched by the API yet
-                    except Exception as e:
+                    except Exception:
                         if self.debug:
-                           logger.error(str(traceback.format_exc()))
-                        err_urls.append(url)
-                        self.exit_status = 1
+                            logger.error(str(traceback.format_exc()))
+                        self.record_error(url)
                         pbar.update(1)
                         continue  # skip the unsupported url
 
+                self.record_results(self.writer.flush())
+                crud.finish_run(self.db, self.run_id)
+
         except KeyboardInterrupt:
-            output_log_cleanup(app_dirs)
+            # save the fetched data before exiting
+            self.record_results(self.writer.flush())
+            self.interrupted_log()
             sys.exit(2)
 
         finally:
-            if self.changelog:
-                build_changelog(urls_input, urls, urls, downloaded_urls,
-                                err_urls, no_updates_urls, self.out_dir)
+            self.throttle_report()
+            self.close_cache()
+            self.changelog.save()
 
     def export_db_as_json(self):
+        if self.export_format not in EXPORT_FORMATS:
+            tqdm.write(Fore.RED +
+                       f"Unsupported export format: {self.export_format}. Use one of: {', '.join(EXPORT_FORMATS)}")
+            self.exit_status = 1
+            return
+
         _, file_name = os.path.split(self.input_db)
         self.db_name = os.path.splitext(file_name)[0]
-        self.json_file = os.path.join(self.out_dir, self.db_name)+".json"
+        self.json_file = os.path.join(
+            self.out_dir, self.db_name)+f".{self.export_format}"
 
         if os.path.isfile(self.input_db):
-            self.engine, self.SessionLocal = init_database(self.input_db)
+            self.db_file = self.input_db
+            self.open_database()
         else:
             db_not_found_log(self.debug, self.input_db)
             sys.exit(1)
 
+        # the columns of the latest schema are exported
+        self.run_migrations()
+
         if self.input_db:
-            self.db: Session = next(get_db(self.SessionLocal))
-            crud.dump_json(self.db, self.input_db, self.json_file, self.debug)
+            crud.dump_db(self.db, self.input_db, self.json_file,
+                         self.export_format, self.debug, self.export_since)
         else:
             tqdm.write(Fore.RED +
                        "SQLite db is not found. Use an existing sqlite db using: --input-db ")
 
+    def search_db(self, query: str, limit: int = 20, page: int = 1):
+        """ Show a page of the fics matching the search words, best
+            match first
+        """
+        if os.path.isfile(self.input_db):
+            self.db_file = self.input_db
+            self.open_database()
+        else:
+            db_not_found_log(self.debug, self.input_db)
+            sys.exit(1)
+
+        # the search index is added by the migrations
+        self.run_migrations()
+
+        match = match_query(query)
+        if not match:
+            tqdm.write(Fore.RED + "Nothing to search for!")
+            self.exit_status = 1
+            return
+
+        if self.debug:
+            logger.info(f"Search: {match}")
+        try:
+            total, rows = crud.search_rows(
+                self.db, match, limit, (page - 1) * limit)
+        except OperationalError as e:
+            # no fichub_search table if SQLite is built without FTS5
+            if self.debug:
+                logger.error(str(e))
+            tqdm.write(Fore.RED + f"Search failed: {e.orig}")
+            self.exit_status = 1
+            return
+
+        if not rows:
+            tqdm.write(Fore.RED + f"No results found for '{query}'" +
+                       (f" on page {page}" if total else ""))
+            return
+
+        first = (page - 1) * limit + 1
+        tqdm.write(Fore.GREEN + f"Found {total} fics. Showing {first}-{first + len(rows) - 1}:\n")
+        for n, row in enumerate(rows, first):
+            tqdm.write(Fore.BLUE + f"{n}. {row.title}" + Style.RESET_ALL +
+                       f" by {row.author}")
+            tqdm.write(f"   {row.fandom or ''} | {row.words or 0} words | {row.status}")
+            tqdm.write(Fore.CYAN + f"   {row.source}" + Style.RESET_ALL)
+
+        if first + len(rows) - 1 < total:
+            tqdm.write(Fore.GREEN + f"\nUse --page {page + 1} for more results.")
+
+    def query_db(self, columns: list, filters: dict, sort: str = None,
+                 limit: int = None, output_format: str = "table",
+                 out_file: str = "-"):
+        """ Write the requested columns of the rows matching the filters,
+            streamed to stdout or a file
+        """
+        table_columns = list(models.Metadata.__table__.columns.keys())
+        tag_kinds = [kind for _, kind in TAG_COLUMNS]
+        errors = [f"Unknown column: {col}. Use one of: {', '.join(table_columns)}"
+                  for col in columns + ([sort.lstrip("-")] if sort else [])
+                  if col not in table_columns]
+        if output_format not in QUERY_FORMATS:
+            errors.append(
+                f"Unsupported output format: {output_format}. Use one of: {', '.join(QUERY_FORMATS)}")
+        errors += [f"Unknown tag kind: {kind}. Use one of: {', '.join(tag_kinds)}"
+                   for kind, _ in filters.get("tags", []) if kind not in tag_kinds]
+        if errors:
+            for error in errors:
+                tqdm.write(Fore.RED + error, file=sys.stderr)
+            self.exit_status = 1
+            return
+
+        if os.path.isfile(self.input_db):
+            self.db_file = self.input_db
+            self.open_database()
+        else:
+            db_not_found_log(self.debug, self.input_db)
+            sys.exit(1)
+
+        # the indexes for the filters are added by the migrations
+        self.run_migrations()
+
+        count = 0
+
+        def rows():
+            nonlocal count
+            for row in crud.query_rows(self.db, columns, sort=sort,
+                                       limit=limit, **filters):
+                count += 1
+                yield row
+
+        try:
+            QUERY_FORMATS[output_format](out_file, columns, rows())
+        except OperationalError as e:
+            if self.debug:
+                logger.error(str(e))
+            db_not_found_log(self.debug, self.db_file)
+            sys.exit(1)
+
+        if self.debug:
+            logger.info(f"Query: {count} rows")
+        if out_file != "-":
+            tqdm.write(Fore.GREEN + f"Saved {count} rows to {out_file}")
+        elif output_format == "table":
+            tqdm.write(Fore.GREEN + f"\n{count} rows" + Style.RESET_ALL,
+                       file=sys.stderr)
+
+    def trending_db(self, stat: str, days: float, limit: int = 20,
+                    output_format: str = "table", out_file: str = "-"):
+        """ Write the fics whose stat grew the most in the last `days`
+        """
+        errors = []
+        if stat not in crud.TRENDING_STATS:
+            errors.append(
+                f"Unsupported stat: {stat}. Use one of: {', '.join(crud.TRENDING_STATS)}")
+        if output_format not in QUERY_FORMATS:
+            errors.append(
+                f"Unsupported output format: {output_format}. Use one of: {', '.join(QUERY_FORMATS)}")
+        if errors:
+            for error in errors:
+                tqdm.write(Fore.RED + error, file=sys.stderr)
+            self.exit_status = 1
+            return
+
+        if os.path.isfile(self.input_db):
+            self.db_file = self.input_db
+            self.open_database()
+        else:
+            db_not_found_log(self.debug, self.input_db)
+            sys.exit(1)
+
+        # the history table is added by the migrations
+        self.run_migrations()
+
+        since_ts = int(time.time() - days * 24 * 60 * 60)
+        rows = list(crud.trending_rows(self.db, stat, since_ts, limit))
+        if not rows:
+            tqdm.write(Fore.RED + f"No {stat} changes found in the last {days:g} days. "
+                       "The history is recorded by --update-db.", file=sys.stderr)
+            return
+
+        QUERY_FORMATS[output_format](
+            out_file, ["growth", "title", "author", stat, "source"], rows)
+        if out_file != "-":
+            tqdm.write(Fore.GREEN + f"Saved {len(rows)} rows to {out_file}")
+
     def db_backup(self, suffix):
-        """ Creates a backup db in the same directory as the sqlite db
+        """ Creates a backup db in the same directory as the sqlite db,
+            at most once per run
         """
+        if self.no_backup or self.backup_done:
+            return
+
+        if not os.path.isfile(self.db_file):
+            raise FileNotFoundError(self.db_file)
+
         timestamp = datetime.now().strftime("%Y-%m-%d T%H%M%S")
         backup_out_dir, file_name = os.path.split(self.db_file)
         db_name = os.path.splitext(file_name)[0]
         backup_db_path = os.path.join(
             backup_out_dir, f"{db_name}.{suffix} - {timestamp}.sqlite")
-        shutil.copy(self.db_file, backup_db_path)
+
+        # use the online backup api, which gives a consistent copy even if
+        # the db is open elsewhere
+        src = sqlite3.connect(self.db_file)
+        dst = sqlite3.connect(backup_db_path)
+        try:
+            with dst:
+                src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        self.backup_done = True
 
         if self.debug:
             logger.info(f"Created backup db '{backup_db_path}'")
         tqdm.write(Fore.BLUE + f"Created backup db '{backup_db_path}'")
 
-    def run_migrations(self):
-        """ Migrates the db from old db schema to the new one
+        if self.keep_backups:
+            self.rotate_backups(backup_out_dir, db_name)
+
+    def rotate_backups(self, backup_out_dir, db_name):
+        """ Delete all but the latest `keep_backups` backups of the db
         """
-        if os.path.isfile(self.input_db):
-            self.db_file = self.input_db
-            self.engine, self.SessionLocal = init_database(self.db_file)
-        else:
-            db_not_found_log(self.debug, self.input_db)
+        backups = sorted(
+            glob.glob(os.path.join(glob.escape(backup_out_dir),
+                                   f"{glob.escape(db_name)}.pre.* - *.sqlite")),
+            key=os.path.getmtime, reverse=True)
+
+        for backup_db_path in backups[self.keep_backups:]:
+            os.remove(backup_db_path)
+            if self.debug:
+                logger.info(f"Deleted old backup db '{backup_db_path}'")
+
+    def open_database(self):
+        """ Create the engine & the session for the db, once per run
+        """
+        if self.engine is not None:
+            return
+
+        if self.db_profile not in DB_PROFILES:
+            tqdm.write(Fore.RED +
+                       f"Unsupported db profile: {self.db_profile}. Use one of: {', '.join(DB_PROFILES)}")
             sys.exit(1)
 
+        if self.debug:
+            logger.info(
+                f"Opening '{self.db_file}' with the '{self.db_profile}' profile")
+        self.engine, self.SessionLocal = init_database(
+            self.db_file, self.db_profile, self.debug)
         self.db: Session = next(get_db(self.SessionLocal))
 
+    def run_migrations(self):
+        """ Migrates the db from old db schema to the new one
+        """
         try:
-            crud.add_fichub_id_column(self.db, self.db_backup, self.debug)
-            crud.add_db_last_updated_column(
-                self.db, self.db_backup, self.debug)
-            crud.add_rawExtendedMeta_columns(
-                self.db, self.db_backup, self.debug)
-            crud.rename_favs_column(
-                self.db, self.db_backup, self.debug)
-            
+            migrations.migrate(self.engine, self.db_backup, self.debug,
+                               lambda: self.config)
         except OperationalError as e:
             if self.debug:
                 logger.info(Fore.RED + str(e))
+            db_not_found_log(self.debug, self.db_file)
             sys.exit(1)
 
-    def fetch_urls_from_page(self, fetch_urls: str, user_contact: str = None):
-
+    def fetch_urls_from_page(self, fetch_urls: str, user_contact: str = None,
+                             pages: tuple = None):
+        """ Save the works & series urls found on an AO3 page. With
+            `pages` as (first, last), each page of the listing is crawled
+        """
         if user_contact is None:
             user_contact = prompt_user_contact()
 
-        params = {
-            # 'view_full_work': 'true',
-            'view_adult': 'true'
-        }
-
-        headers = {
-            'User-Agent': f'Bot: fichub_cli_metadata/{plugin_version} (User: {user_contact}, Bot: https://github.com/fichub-cli-contrib/fichub-cli-metadata)'
-        }
-
         if self.debug:
             logger.debug("--fetch-urls flag used!")
             logger.info(f"Processing {fetch_urls}")
 
-        with console.status(f"[bold green]Processing {fetch_urls}"):
-            response = requests.get(
-                fetch_urls, timeout=(5, 300),
-                headers=headers, params=params)
-
-            if response.status_code == 429:
-                if self.debug:
-                    logger.error("HTTP Error 429: TooManyRequests")
-                    logger.debug("Sleeping for 30s")
-                tqdm.write("Too Many Requests!\nSleeping for 30s!\n")
-                time.sleep(30)
-
-                if self.debug:
-                    logger.info("Resuming downloads!")
-                tqdm.write("Resuming downloads!")
-
-                # retry GET request
-                response = requests.get(
-                    fetch_urls, timeout=(5, 300), params=params)
+        found = {"works": [], "series": []}
+        files = {}
+        try:
+            if re.search("https://archiveofourown.org/", fetch_urls):
+                for kind, url in self.discover_urls(fetch_urls, user_contact, pages):
+                    found[kind].append(url)
 
-            if self.debug:
-                logger.debug(f"GET: {response.status_code}: {response.url}")
+                    # stream the urls to the lists while the crawl is running
+                    if kind not in files:
+                        files[kind] = open(f"ao3_{kind}_list.txt", "a")
+                    files[kind].write(url + "\n")
+        finally:
+            for file in files.values():
+                file.close()
 
-            html_page = BeautifulSoup(response.content, 'html.parser')
+        for kind, urls in found.items():
+            if urls:
+                tqdm.write(Fore.GREEN +
+                           f"\nFound {len(urls)} {kind} urls." +
+                           Style.RESET_ALL)
+                if pages is None:
+                    tqdm.write('\n'.join(urls))
+                tqdm.write(Fore.BLUE + f"\nSaving the list to 'ao3_{kind}_list.txt' in the current directory"
+                           + Style.RESET_ALL)
+
+        if not found["works"] and not found["series"]:
+            tqdm.write(Fore.RED + "\nFound 0 urls.")
+            self.exit_status = 1
+
+        self.throttle_report()
+
+    def ingest_from_page(self, fetch_urls: str, user_contact: str = None,
+                         pages: tuple = None):
+        """ Save the metadata of the works urls found on an AO3 page (or
+            pages) while the crawl is still running, without writing the
+            url lists. The urls already in the db are skipped before any
+            API call
+        """
+        if user_contact is None:
+            user_contact = prompt_user_contact()
 
-            found_flag = False
-            if re.search("https://archiveofourown.org/", fetch_urls):
-                ao3_series_works_html = []
-                ao3_works_list = []
-                ao3_series_list = []
+        if self.debug:
+            logger.debug("--fetch-urls --ingest flags used!")
+            logger.info(f"Processing {fetch_urls}")
 
-                ao3_series_works_html_h4 = html_page.find_all(
-                    'h4', attrs={'class': 'heading'})
+        if not re.search("https://archiveofourown.org/", fetch_urls):
+            tqdm.write(Fore.RED + "\nFound 0 urls.")
+            self.exit_status = 1
+            return
+
+        self.changelog = Changelog(self.out_dir, self.save_changelog)
+        self.create_database("ao3_works")
+        done_urls = self.init_writer(
+            update=self.force, kind="save", run_input=fetch_urls,
+            resume_args=f'--fetch-urls "{fetch_urls}" --ingest')
+
+        found = queue.Queue()
+        stop = threading.Event()
+
+        def discover():
+            try:
+                for kind, url in self.discover_urls(fetch_urls, user_contact, pages):
+                    if stop.is_set():
+                        break
+                    if kind == "works":
+                        found.put(url)
+            except Exception:
+                if self.debug:
+                    logger.error(str(traceback.format_exc()))
+                self.exit_status = 1
+            finally:
+                found.put(None)  # end of the crawl
 
-                for i in ao3_series_works_html_h4:
-                    ao3_series_works_html.append(i)
+        skipped = 0
 
-                ao3_series_works_html = ""
-                for i in ao3_series_works_html_h4:
-                    ao3_series_works_html += str(i)
+        def new_urls():
+            nonlocal skipped
+            for url in read_urls(iter(found.get, None), self.changelog, self.debug):
+                if url in done_urls or (url in self.source_index and not self.force):
+                    skipped += 1
+                    continue
+                yield url
 
-                ao3_urls = BeautifulSoup(ao3_series_works_html, 'html.parser')
+        threading.Thread(target=discover, daemon=True).start()
+        try:
+            self.save_urls(new_urls())
+        finally:
+            stop.set()
+            if skipped:
+                if self.debug:
+                    logger.info(
+                        f"Skipped {skipped} urls which are already in the database.")
+                tqdm.write(Fore.GREEN +
+                           f"Skipped {skipped} urls which are already in the database.")
+            self.throttle_report()
+            self.close_cache()
+            self.changelog.save()
+
+    def discover_urls(self, fetch_urls: str, user_contact: str, pages: tuple = None):
+        """ Yield (kind, url) for each new works & series url found on the
+            page, or on each page of the listing in the `pages` range. The
+            pages are fetched concurrently within the rate limit & the urls
+            are deduped across the pages
+        """
+        headers = {
+            'User-Agent': f'Bot: fichub_cli_metadata/{plugin_version} (User: {user_contact}, Bot: https://github.com/fichub-cli-contrib/fichub-cli-metadata)'
+        }
+        seen = set()
 
-                for tag in ao3_urls.find_all('a', {'href': re.compile('/works/')}):
-                    ao3_works_list.append(
-                        "https://archiveofourown.org"+tag['href'])
+        def get_listing(url: str):
+            return parse_listing(self.get_page(url, headers), url)
 
-                for tag in ao3_urls.find_all('a', {'href': re.compile('/series/')}):
-                    ao3_series_list.append(
-                        "https://archiveofourown.org"+tag['href'])
+        def new_urls(page: str, result):
+            try:
+                listing = result()
+            except requests.exceptions.RequestException as e:
+                if self.debug:
+                    logger.error(str(traceback.format_exc()))
+                tqdm.write(Fore.RED + f"Failed to fetch {page}: {e}")
+                self.exit_status = 1
+                return None, []
 
-                if ao3_works_list:
-                    found_flag = True
-                    tqdm.write(Fore.GREEN +
-                               f"\nFound {len(ao3_works_list)} works urls." +
-                               Style.RESET_ALL)
-                    ao3_works_list = '\n'.join(ao3_works_list)
-                    tqdm.write(ao3_works_list + Fore.BLUE + "\n\nSaving the list to 'ao3_works_list.txt' in the current directory"
-                               + Style.RESET_ALL)
+            urls = [(kind, url) for kind, kind_urls in
+                    (("works", listing.works), ("series", listing.series))
+                    for url in kind_urls if url not in seen]
+            seen.update(url for _, url in urls)
+            return listing, urls
 
-                    with open("ao3_works_list.txt", "a") as f:
-                        f.write(ao3_works_list+"\n")
+        if pages is None:
+            first, last = None, None
+            page_urls = [fetch_urls]
+        else:
+            first, last = pages
+            page_urls = [page_url(fetch_urls, n) for n in range(
+                first, (last or first) + 1)]
+
+        with tqdm(total=len(page_urls), ascii=False,
+                  unit="page", bar_format=bar_format) as pbar:
+            listing = None
+            for page, future in fetch_concurrently(get_listing, page_urls, self.workers):
+                listing, urls = new_urls(page, future.result)
+                pbar.update(1)
+                yield from urls
+
+            if pages is None or last is not None or listing is None:
+                return
+
+            # follow the pagination to the last page
+            if listing.last_page:
+                page_urls = [page_url(fetch_urls, n) for n in range(
+                    first + 1, listing.last_page + 1)]
+                pbar.total += len(page_urls)
+                pbar.refresh()
+                for page, future in fetch_concurrently(get_listing, page_urls, self.workers):
+                    _, urls = new_urls(page, future.result)
+                    pbar.update(1)
+                    yield from urls
+
+            # no page numbers, go through the next links one by one
+            else:
+                while listing is not None and listing.next_url:
+                    page = listing.next_url
+                    listing, urls = new_urls(page, lambda: get_listing(page))
+                    pbar.total += 1
+                    pbar.update(1)
+                    yield from urls
+
+    def get_page(self, url: str, headers: dict):
+        """ GET a page, retrying a 429 after the pause of the rate limiter.
+            Raises a HTTPError if it still fails
+        """
+        params = {
+            # 'view_full_work': 'true',
+            'view_adult': 'true'
+        }
 
-                    self.exit_status = 0
+        for attempt in range(self.max_retries + 1):
+            response = self.http.get(
+                url, timeout=(5, 300),
+                headers=headers, params=params)
 
-                if ao3_series_list:
-                    found_flag = True
-                    tqdm.write(Fore.GREEN +
-                               f"\nFound {len(ao3_series_list)} series urls." +
-                               Style.RESET_ALL)
-                    ao3_series_list = '\n'.join(ao3_series_list)
-                    tqdm.write(ao3_series_list + Fore.BLUE + "\n\nSaving the list to 'ao3_series_list.txt' in the current directory"
-                               + Style.RESET_ALL)
+            if self.debug:
+                logger.debug(f"GET: {response.status_code}: {response.url}")
 
-                    with open("ao3_series_list.txt", "a") as f:
-                        f.write(ao3_series_list+"\n")
+            if response.status_code != 429 or attempt == self.max_retries:
+                break
 
-                    self.exit_status = 0
+            # the limiter holds the next request until the Retry-After
+            if self.debug:
+                logger.error("HTTP Error 429: TooManyRequests")
+            tqdm.write("Too Many Requests! Retrying after a pause.\n")
 
-            if found_flag is False:
-                tqdm.write(Fore.RED + "\nFound 0 urls.")
-                self.exit_status = 1
+        response.raise_for_status()
+        return response.content
@@ -0,0 +1,317 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tqdm import tqdm
+from colorama import Fore
+from loguru import logger
+
+from . import models
+from .crud import save_tags
+from .processing import get_tags, to_epoch
+from .export import to_int
+
+BACKFILL_CHUNK = 5000
+
+# the time formats of the fichub_cli config, if no config loader is given
+DEFAULT_CONFIG = {'db_up_time_format': r'%Y-%m-%dT%H:%M:%S%z',
+                  'fic_up_time_format': r'%Y-%m-%dT%H:%M:%S'}
+TIMESTAMP_COLUMNS = ['created_ts', 'fic_last_updated_ts', 'db_last_updated_ts']
+STAT_COLUMNS = ['chapters', 'reviews', 'favorites', 'follows', 'words']
+
+
+def stat_deltas(template: str):
+    return ", ".join(template.format(col=col) for col in STAT_COLUMNS)
+
+
+# record the stat deltas of an update, if any stat changed. A missing stat
+# counts as 0 & two updates within the same second are summed
+HISTORY_TRIGGER = f"""CREATE TRIGGER IF NOT EXISTS fichub_metadata_history_update AFTER UPDATE OF {', '.join(STAT_COLUMNS)} ON fichub_metadata
+    WHEN {' OR '.join(f'old.{col} IS NOT new.{col}' for col in STAT_COLUMNS)} BEGIN
+        INSERT INTO fichub_metadata_history (ts, fic_id, {', '.join(STAT_COLUMNS)})
+        VALUES (COALESCE(new.db_last_updated_ts, CAST(strftime('%s', 'now') AS INTEGER)), new.id,
+            {stat_deltas('COALESCE(new.{col}, 0) - COALESCE(old.{col}, 0)')})
+        ON CONFLICT (ts, fic_id) DO UPDATE SET {stat_deltas('{col} = {col} + excluded.{col}')};
+    END;"""
+
+# full-text index over the metadata table, without a copy of the text
+# (external content), kept in sync by the triggers
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS fichub_search USING fts5(title, description, author, fandom, content='fichub_metadata', content_rowid='id', tokenize='unicode61 remove_diacritics 2');",
+    """CREATE TRIGGER IF NOT EXISTS fichub_search_insert AFTER INSERT ON fichub_metadata BEGIN
+        INSERT INTO fichub_search (rowid, title, description, author, fandom) VALUES (new.id, new.title, new.description, new.author, new.fandom);
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS fichub_search_delete AFTER DELETE ON fichub_metadata BEGIN
+        INSERT INTO fichub_search (fichub_search, rowid, title, description, author, fandom) VALUES ('delete', old.id, old.title, old.description, old.author, old.fandom);
+    END;""",
+    # the upserts rewrite every column, only reindex if the text changed
+    """CREATE TRIGGER IF NOT EXISTS fichub_search_update AFTER UPDATE OF title, description, author, fandom ON fichub_metadata
+    WHEN old.title IS NOT new.title OR old.description IS NOT new.description OR old.author IS NOT new.author OR old.fandom IS NOT new.fandom BEGIN
+        INSERT INTO fichub_search (fichub_search, rowid, title, description, author, fandom) VALUES ('delete', old.id, old.title, old.description, old.author, old.fandom);
+        INSERT INTO fichub_search (rowid, title, description, author, fandom) VALUES (new.id, new.title, new.description, new.author, new.fandom);
+    END;""",
+]
+
+# The schema version is stored in PRAGMA user_version. Dbs created before
+# the versioning have user_version 0, so every step also checks the actual
+# schema to see if it still has to be applied.
+
+
+def add_fichub_id_column(conn, columns, indexes, debug: bool):
+    """ To add a column AFTER an existing column
+    """
+    conn.exec_driver_sql("DROP TABLE IF EXISTS TempFichubMetadata;")
+    conn.exec_driver_sql("ALTER TABLE fichub_metadata RENAME TO TempFichubMetadata;")
+    conn.exec_driver_sql("CREATE TABLE fichub_metadata(id INTEGER NOT NULL, fichub_id VARCHAR(255),title VARCHAR(255), author VARCHAR(255), chapters INTEGER, created VARCHAR(255), description VARCHAR(255), rated VARCHAR(255), language VARCHAR(255), genre VARCHAR(255), characters VARCHAR(255), reviews INTEGER, favs INTEGER, follows INTEGER, status VARCHAR(255), words INTEGER, last_updated VARCHAR(255), source VARCHAR(255), PRIMARY KEY(id));")
+    conn.exec_driver_sql("INSERT INTO fichub_metadata (id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status, words, last_updated, source ) SELECT id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status, words,last_updated, source FROM TempFichubMetadata;")
+    conn.exec_driver_sql("DROP TABLE TempFichubMetadata;")
+
+
+def add_db_last_updated_column(conn, columns, indexes, debug: bool):
+    """ To add a column AFTER an existing column
+    """
+    conn.exec_driver_sql("DROP TABLE IF EXISTS TempFichubMetadata;")
+    conn.exec_driver_sql("ALTER TABLE fichub_metadata RENAME TO TempFichubMetadata;")
+    conn.exec_driver_sql("CREATE TABLE fichub_metadata(id INTEGER NOT NULL, fichub_id VARCHAR(255), title VARCHAR(255), author VARCHAR(255), chapters INTEGER, created VARCHAR(255), description VARCHAR(255), rated VARCHAR(255), language VARCHAR(255), genre VARCHAR(255), characters VARCHAR(255), reviews INTEGER, favs INTEGER, follows INTEGER, status VARCHAR(255), words INTEGER, fic_last_updated VARCHAR(255), db_last_updated VARCHAR(255), source VARCHAR(255), PRIMARY KEY(id));")
+    conn.exec_driver_sql("INSERT INTO fichub_metadata (id, fichub_id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status,  words, fic_last_updated, source ) SELECT id, fichub_id, title, author, chapters, created, description, rated, language, genre, characters, reviews, favs, follows, status, words, last_updated, source FROM TempFichubMetadata;")
+    conn.exec_driver_sql("DROP TABLE TempFichubMetadata;")
+
+
+def add_rawExtendedMeta_columns(conn, columns, indexes, debug: bool):
+    """ To add fic_id, author_id, author_url, fandom columns
+    """
+    for col in ['fic_id', 'author_id', 'author_url', 'fandom']:
+        if col not in columns:
+            conn.exec_driver_sql(
+                f"ALTER TABLE fichub_metadata ADD {col} TEXT DEFAULT '';")
+
+
+def rename_favs_column(conn, columns, indexes, debug: bool):
+    """ To rename favs column to favorites
+    """
+    conn.exec_driver_sql(
+        "ALTER TABLE fichub_metadata RENAME COLUMN favs TO favorites;")
+
+
+def add_indexes(conn, columns, indexes, debug: bool):
+    """ To add a unique index on the source column, removing the
+        duplicate rows first. Also restores the author index, which was
+        dropped by the table rebuilds of the older migrations
+    """
+    if "ix_fichub_metadata_source" not in indexes:
+        # keep the oldest row for each source
+        deleted = conn.exec_driver_sql("DELETE FROM fichub_metadata WHERE source IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM fichub_metadata GROUP BY source);")
+        if deleted.rowcount:
+            if debug:
+                logger.info(
+                    f"Migration: removed {deleted.rowcount} duplicate rows")
+            tqdm.write(
+                Fore.GREEN + f"Migration: removed {deleted.rowcount} duplicate rows")
+        conn.exec_driver_sql("CREATE UNIQUE INDEX ix_fichub_metadata_source ON fichub_metadata (source);")
+
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fichub_metadata_author ON fichub_metadata (author);")
+
+
+def add_checkpoint_tables(conn, columns, indexes, debug: bool):
+    """ To add the run & checkpoint tables used by --resume
+    """
+    models.Base.metadata.create_all(
+        bind=conn, tables=[models.Run.__table__, models.Checkpoint.__table__])
+
+
+def add_tag_tables(conn, columns, indexes, debug: bool):
+    """ To add the tag tables & fill them from the genre, characters &
+        fandom columns of the existing rows
+    """
+    models.Base.metadata.create_all(
+        bind=conn, tables=[models.Tag.__table__, models.FicTag.__table__])
+
+    last_id, total = 0, 0
+    while True:
+        rows = conn.exec_driver_sql(
+            "SELECT id, genre, characters, fandom FROM fichub_metadata WHERE id > ? ORDER BY id LIMIT ?;",
+            (last_id, BACKFILL_CHUNK)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        total += len(rows)
+        save_tags(conn, {row_id: get_tags(
+            {"genre": genre, "characters": characters, "fandom": fandom})
+            for row_id, genre, characters, fandom in rows}, replace=False)
+
+    if debug:
+        logger.info(f"Migration: added the tags of {total} rows")
+
+
+def add_search_index(conn, columns, indexes, debug: bool):
+    """ To add the full-text search index of the existing rows & the
+        triggers which keep it up to date
+    """
+    if not conn.exec_driver_sql(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5');").scalar():
+        if debug:
+            logger.error("SQLite is built without FTS5, search is disabled")
+        tqdm.write(Fore.YELLOW + "SQLite is built without FTS5, search is disabled")
+        return
+
+    for statement in SEARCH_INDEX_DDL:
+        conn.exec_driver_sql(statement)
+    conn.exec_driver_sql(
+        "INSERT INTO fichub_search (fichub_search) VALUES ('rebuild');")
+
+
+def add_query_indexes(conn, columns, indexes, debug: bool):
+    """ To add the composite indexes for the query filters. The ones on
+        the dates are added with the timestamp columns
+    """
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fichub_metadata_rated_words ON fichub_metadata (rated, words);")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_fichub_metadata_words ON fichub_metadata (words);")
+
+
+def add_timestamp_columns(conn, columns, indexes, debug: bool):
+    """ To add the unix timestamp columns of the dates & fill them by
+        parsing the date strings with the time formats of the config.
+        The stats stored as strings e.g. "1,234" are converted to ints
+    """
+    for col in TIMESTAMP_COLUMNS:
+        if col not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE fichub_metadata ADD {col} INTEGER;")
+
+    load_config = conn.info.get("load_config")
+    config = load_config() if load_config else DEFAULT_CONFIG
+    last_id = 0
+    while True:
+        rows = conn.exec_driver_sql(
+            f"SELECT id, created, fic_last_updated, db_last_updated, {', '.join(STAT_COLUMNS)} FROM fichub_metadata WHERE id > ? ORDER BY id LIMIT ?;",
+            (last_id, BACKFILL_CHUNK)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        conn.exec_driver_sql(
+            f"UPDATE fichub_metadata SET {', '.join(col + ' = ?' for col in TIMESTAMP_COLUMNS + STAT_COLUMNS)} WHERE id = ?;",
+            # created is stored as given by the API
+            [(to_epoch(created),
+              to_epoch(fic_last_updated, config['fic_up_time_format']),
+              to_epoch(db_last_updated, config['db_up_time_format'], utc=False),
+              *(to_int(stat) for stat in stats), row_id)
+             for row_id, created, fic_last_updated, db_last_updated, *stats in rows])
+
+    # the indexes on the string dates of older versions
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_fichub_metadata_status_updated;")
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_fichub_metadata_fic_last_updated;")
+    for index in models.Metadata.__table__.indexes:
+        index.create(bind=conn, checkfirst=True)
+
+
+def add_history_table(conn, columns, indexes, debug: bool):
+    """ To add the stats history table & the trigger which fills it
+    """
+    models.Base.metadata.create_all(
+        bind=conn, tables=[models.History.__table__])
+    conn.exec_driver_sql(HISTORY_TRIGGER)
+
+
+# (version, description, check if the step is needed, step)
+MIGRATIONS = [
+    (1, "adding fichub_id column",
+     lambda columns, indexes: "fichub_id" not in columns,
+     add_fichub_id_column),
+    (2, "adding db_last_updated column",
+     lambda columns, indexes: "db_last_updated" not in columns,
+     add_db_last_updated_column),
+    (3, "adding fic_id, author_id, author_url & fandom columns",
+     lambda columns, indexes: not {'fic_id', 'author_id', 'author_url', 'fandom'} <= columns,
+     add_rawExtendedMeta_columns),
+    (4, "renaming favs column to favorites",
+     lambda columns, indexes: "favorites" not in columns,
+     rename_favs_column),
+    (5, "adding unique index on the source column",
+     lambda columns, indexes: not {"ix_fichub_metadata_source", "ix_fichub_metadata_author"} <= indexes,
+     add_indexes),
+    (6, "adding run checkpoint tables",
+     lambda columns, indexes: True,
+     add_checkpoint_tables),
+    (7, "adding tag tables",
+     lambda columns, indexes: True,
+     add_tag_tables),
+    (8, "adding full-text search index",
+     lambda columns, indexes: True,
+     add_search_index),
+    (9, "adding indexes for the query filters",
+     lambda columns, indexes: True,
+     add_query_indexes),
+    (10, "adding timestamp columns",
+     lambda columns, indexes: True,
+     add_timestamp_columns),
+    (11, "adding stats history table",
+     lambda columns, indexes: True,
+     add_history_table),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_info(conn):
+    """ Return the column & index names of the metadata table
+    """
+    columns = {row[1] for row in conn.exec_driver_sql(
+        "PRAGMA table_info(fichub_metadata);")}
+    indexes = {row[1] for row in conn.exec_driver_sql(
+        "PRAGMA index_list(fichub_metadata);")}
+    return columns, indexes
+
+
+def migrate(engine, db_backup, debug: bool, load_config=None):
+    """ Migrates the db from old db schema to the new one. The pending
+        steps are applied in a single transaction after one backup.
+        load_config returns the config with the time formats to parse the
+        dates of the old rows, it is only called if they are migrated
+    """
+    with engine.connect() as conn:
+        conn.info["load_config"] = load_config
+        version = conn.exec_driver_sql("PRAGMA user_version;").scalar()
+        if version >= SCHEMA_VERSION:
+            return
+
+        columns, indexes = get_schema_info(conn)
+        pending = [step for step in MIGRATIONS
+                   if step[0] > version and step[2](columns, indexes)]
+
+        if columns and pending:
+            tqdm.write(
+                Fore.GREEN + "Database Schema changes detected! Migrating the database.")
+            # backup the db before migrating the data
+            db_backup("pre.migration")
+
+        # pysqlite doesnt start a transaction for DDL statements by itself
+        conn.exec_driver_sql("BEGIN;")
+        try:
+            if not columns:
+                # new db, nothing to migrate
+                models.Base.metadata.create_all(bind=conn)
+                add_search_index(conn, columns, indexes, debug)
+                add_history_table(conn, columns, indexes, debug)
+            else:
+                for step_version, description, is_needed, step in MIGRATIONS:
+                    if step_version <= version or not is_needed(columns, indexes):
+                        continue
+                    if debug:
+                        logger.info(f"Migration: {description}")
+                    tqdm.write(Fore.GREEN + f"Migration: {description}")
+                    step(conn, columns, indexes, debug)
+                    columns, indexes = get_schema_info(conn)
+
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION};")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
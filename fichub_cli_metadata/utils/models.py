@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Index
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -20,6 +20,14 @@ Base = declarative_base()
 
 class Metadata(Base):
     __tablename__ = "fichub_metadata"
+    __table_args__ = (
+        # for the filters & sorts of the query subcommand
+        Index("ix_fichub_metadata_status_updated_ts", "status", "fic_last_updated_ts"),
+        Index("ix_fichub_metadata_rated_words", "rated", "words"),
+        Index("ix_fichub_metadata_words", "words"),
+        Index("ix_fichub_metadata_fic_last_updated_ts", "fic_last_updated_ts"),
+        Index("ix_fichub_metadata_db_last_updated_ts", "db_last_updated_ts"),
+    )
 
     id = Column(Integer, primary_key=True)
     fic_id = Column(Integer)
@@ -43,4 +51,69 @@ class Metadata(Base):
     fandom = Column(String)
     fic_last_updated = Column(String)
     db_last_updated = Column(String)
-    source = Column(String)
+    source = Column(String, index=True, unique=True)
+    # the dates as unix timestamps, for the range queries & sorting
+    created_ts = Column(Integer)
+    fic_last_updated_ts = Column(Integer)
+    db_last_updated_ts = Column(Integer)
+
+
+class Run(Base):
+    __tablename__ = "fichub_runs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)
+    input = Column(String)
+    started = Column(String)
+    finished = Column(String)
+
+
+class Checkpoint(Base):
+    __tablename__ = "fichub_checkpoints"
+
+    run_id = Column(Integer, primary_key=True)
+    url = Column(String, primary_key=True)
+    state = Column(String)
+    attempts = Column(Integer, default=1)
+    updated = Column(String)
+
+
+class Tag(Base):
+    __tablename__ = "fichub_tags"
+    __table_args__ = (
+        Index("ix_fichub_tags_kind_name", "kind", "name", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)  # genre, character or fandom
+    name = Column(String(collation="NOCASE"))
+
+
+class FicTag(Base):
+    __tablename__ = "fichub_fic_tags"
+    __table_args__ = (
+        Index("ix_fichub_fic_tags_fic_id", "fic_id"),
+        {"sqlite_with_rowid": False},
+    )
+
+    # the primary key is the index for the tag -> fics lookups
+    tag_id = Column(Integer, primary_key=True)
+    fic_id = Column(Integer, primary_key=True)  # fichub_metadata.id
+
+
+class History(Base):
+    """ Changes of the stats of a fic, filled by a trigger on the updates
+        of fichub_metadata. Only the deltas are stored, one row per fic &
+        update which changed a stat
+    """
+    __tablename__ = "fichub_metadata_history"
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    # the primary key is the index for the aggregates over a time window
+    ts = Column(Integer, primary_key=True)  # db_last_updated_ts
+    fic_id = Column(Integer, primary_key=True)  # fichub_metadata.id
+    words = Column(Integer)
+    chapters = Column(Integer)
+    reviews = Column(Integer)
+    favorites = Column(Integer)
+    follows = Column(Integer)
@@ -12,26 +12,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 from tqdm import tqdm
 from colorama import Fore, Style
 from loguru import logger
 import json
 import os
-from sqlalchemy import create_engine, inspect
+import sys
+import time
+import sqlite3
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from platformdirs import PlatformDirs
 from fichub_cli.utils.processing import process_extendedMeta
+from .export import to_int
 
-from . import models
 app_dirs = PlatformDirs("fichub_cli", "fichub")
 
 
-def init_database(db):
+# PRAGMAs applied to every new connection of the engine
+DB_PROFILES = {
+    # sqlite defaults: rollback journal, synchronous=FULL
+    "default": {},
+    # WAL is durable against crashes of the app, only a power loss can
+    # roll back the last transactions
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+        "cache_size": -64000,  # 64 MB
+        "mmap_size": 268435456,  # 256 MB
+    },
+    # for one-off bulk imports into a new db, not crash safe
+    "bulk": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "temp_store": "MEMORY",
+        "cache_size": -256000,  # 256 MB
+        "mmap_size": 1073741824,  # 1 GB
+    },
+}
+
+
+def init_database(db, profile: str = "fast", debug: bool = False):
     """ Initialize the sqlite database
     """
 
-    engine = create_engine("sqlite:///"+db)
+    engine = create_engine("sqlite:///"+db, future=True)
+    pragmas = DB_PROFILES[profile]
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            try:
+                cursor.execute(f"PRAGMA {pragma} = {value};")
+            # the journal mode cant be changed while the db is in use
+            # elsewhere, keep the current one
+            except sqlite3.OperationalError as e:
+                if debug:
+                    logger.warning(f"PRAGMA {pragma} = {value}: {e}")
+        cursor.close()
+
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
     return engine, SessionLocal
@@ -45,72 +89,220 @@ def get_db(SessionLocal):
         db.close()
 
 
-def get_ins_query(item: dict):
-    """ Return the insert query for the db model
+def fetch_concurrently(fetch, urls, workers: int):
+    """ Call fetch(url) for each url using a pool of worker threads,
+        keeping at most `workers` calls in flight. Yields (url, future)
+        pairs in completion order, so the results can be consumed by a
+        single writer thread
+    """
+    urls = iter(urls)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    in_flight = {}
+    try:
+        for url in islice(urls, workers):
+            in_flight[executor.submit(fetch, url)] = url
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future
+
+                # refill the pool as soon as a slot frees up
+                for url in islice(urls, 1):
+                    in_flight[executor.submit(fetch, url)] = url
+    finally:
+        # dont wait for the in-flight requests on KeyboardInterrupt
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_config(debug: bool):
+    """ Load the CLI config once per run & check that it has the keys
+        needed by the plugin
     """
     try:
         with open(os.path.join(app_dirs.user_data_dir, "config.json"), 'r') as f:
             config = json.load(f)
     except FileNotFoundError as err:
+        if debug:
+            logger.error(str(err))
         tqdm.write(str(err))
         tqdm.write(
             Fore.GREEN + "Run `fichub_cli --config-init` to initialize the CLI config")
-        exit(1)
+        sys.exit(1)
+
+    missing_keys = [key for key in ('db_up_time_format', 'fic_up_time_format')
+                    if key not in config]
+    if missing_keys:
+        if debug:
+            logger.error(f"Config keys not found: {', '.join(missing_keys)}")
+        tqdm.write(
+            Fore.RED + f"Config keys not found: {', '.join(missing_keys)}")
+        tqdm.write(
+            Fore.GREEN + "Run `fichub_cli --config-init` to update the CLI config")
+        sys.exit(1)
+
+    return config
+
+
+def get_db_last_updated(config: dict):
+    """ Return the current time for the db_last_updated columns, formatted
+        with the time format of the config & as a unix timestamp
+    """
+    now = datetime.now().astimezone()
+    return now.strftime(config['db_up_time_format']), int(now.timestamp())
+
+
+def parse_timestamp(value: str, time_format: str):
+    """ Parse a timestamp stored in the db, None if it cant be parsed
+        e.g. if the time format in the config was changed
+    """
+    try:
+        return datetime.strptime(value, time_format)
+    except (TypeError, ValueError):
+        return None
 
-    query = models.Metadata(
+
+def to_epoch(value, time_format: str = None, utc: bool = True):
+    """ Convert a datetime or a timestamp string (ISO 8601 if no format is
+        given) to a unix timestamp, None if it cant be parsed. Naive times
+        are UTC, like the dates from the API, or local time if `utc` is
+        False, like the db_last_updated written without a %z
+    """
+    if not isinstance(value, datetime):
+        if time_format is None:
+            try:
+                value = datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                return None
+        else:
+            value = parse_timestamp(value, time_format)
+        if value is None:
+            return None
+    if value.tzinfo is None and utc:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def local_timestamp(value: datetime):
+    """ Convert a date/time given on the command line to a unix timestamp,
+        a naive one is in the local time
+    """
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return int(value.timestamp())
+
+
+def needs_refresh(status: str, fic_last_updated_ts: int,
+                  db_last_updated_ts: int, complete_ttl: int,
+                  max_backoff: int = 30, now: float = None):
+    """ Decide if a row has to be re-fetched in the incremental mode.
+
+        Completed fics are refreshed once every `complete_ttl` days. For
+        ongoing fics the refresh interval doubles with the time the fic has
+        gone without an update (1 day when stale for 2-3 days, 2 days for
+        4-7 days, ...) up to `max_backoff` days.
+    """
+    if db_last_updated_ts is None:
+        return True
+
+    if now is None:
+        now = time.time()
+    # allow for some jitter in the schedule of daily runs
+    age = timedelta(seconds=now - db_last_updated_ts) + timedelta(hours=1)
+
+    if status and status.lower() == "complete":
+        return age >= timedelta(days=complete_ttl)
+
+    if fic_last_updated_ts is None:
+        return True
+
+    stale_days = timedelta(seconds=now - fic_last_updated_ts).days
+    if stale_days < 2:
+        return True
+    interval = min(max_backoff, 2 ** (stale_days.bit_length() - 2))
+    return age >= timedelta(days=interval)
+
+
+def get_ins_row(item: dict, config: dict):
+    """ Return the row for the db model as a dict of column values. The
+        db_last_updated columns are set when the row is written
+    """
+    fic_last_updated = datetime.fromisoformat(item['updated'])
+    row = dict(
         fichub_id=item['id'],
-        fic_id = process_extendedMeta(item,'id'),
+        fic_id=process_extendedMeta(item, 'id'),
         title=item['title'],
         author=item['author'],
         author_id=item['authorLocalId'],
         author_url=item['authorUrl'],
-        chapters=item['chapters'],
+        chapters=to_int(item['chapters']),
         created=item['created'],
         description=item['description'],
-        rated=process_extendedMeta(item,'rated'),
-        language=process_extendedMeta(item,'language'),
-        genre=process_extendedMeta(item,'genres'),
-        characters=process_extendedMeta(item,'characters'),
-        reviews=process_extendedMeta(item,'reviews'),
-        favorites=process_extendedMeta(item,'favorites'),
-        follows=process_extendedMeta(item,'follows'),
+        rated=process_extendedMeta(item, 'rated'),
+        language=process_extendedMeta(item, 'language'),
+        genre=process_extendedMeta(item, 'genres'),
+        characters=process_extendedMeta(item, 'characters'),
+        reviews=to_int(process_extendedMeta(item, 'reviews')),
+        favorites=to_int(process_extendedMeta(item, 'favorites')),
+        follows=to_int(process_extendedMeta(item, 'follows')),
         status=item['status'],
-        words=item['words'],
-        fandom=process_extendedMeta(item,'raw_fandom'),
-        fic_last_updated=datetime.fromisoformat(item['updated']).strftime(config['fic_up_time_format']),
-        db_last_updated=datetime.now().astimezone().strftime(
-            config['db_up_time_format']),
-        source=item['source']
-
+        words=to_int(item['words']),
+        fandom=process_extendedMeta(item, 'raw_fandom'),
+        fic_last_updated=fic_last_updated.strftime(config['fic_up_time_format']),
+        source=item['source'],
+        created_ts=to_epoch(item['created']),
+        fic_last_updated_ts=to_epoch(fic_last_updated)
     )
-    return query
+    return row
+
 
+# (column, tag kind) of the comma joined tag columns
+TAG_COLUMNS = [("genre", "genre"), ("characters", "character"),
+               ("fandom", "fandom")]
 
-def sql_to_json(json_file: str, query_output, debug):
-    """ Converts output from a SQLAlchemy query to a .json file.
+
+def get_tags(row: dict):
+    """ Split the tag columns of a row into a set of (kind, name). The
+        pairings in brackets e.g. "[Harry P., Hermione G.] Ron W." are
+        split into the characters
     """
-    meta_list = []
-    for row in query_output:
-        row_dict = object_as_dict(row)
-        if debug:
-            logger.info(f"Processing {row_dict['source']}")
-        tqdm.write(Fore.BLUE+f"Processing {row_dict['source']}")
-        meta_list.append(row_dict)
+    tags = set()
+    for column, kind in TAG_COLUMNS:
+        value = row.get(column)
+        if not value:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ",".join(map(str, value))
+        for name in str(value).replace("[", ",").replace("]", ",").split(","):
+            name = name.strip()
+            if name:
+                tags.add((kind, name))
+    return tags
 
-    if meta_list:
-        with open(json_file, 'w') as outfile:
-            if debug:
-                logger.info(f"Saving {json_file}")
-            tqdm.write(Fore.GREEN+f"Saving {json_file}")
-            json.dump(meta_list, outfile)
 
+SEARCH_COLUMNS = ("title", "description", "author", "fandom")
 
-def object_as_dict(obj):
-    """
-    Convert a sqlalchemy object into a dictionary
+
+def match_query(query: str):
+    """ Turn the search words into an FTS5 query, matching all of them.
+        The words are quoted so punctuation cant break the query, a word
+        ending with * is a prefix & column:word searches a single column
     """
-    return {c.key: getattr(obj, c.key)
-            for c in inspect(obj).mapper.column_attrs}
+    terms = []
+    for word in query.split():
+        column, sep, rest = word.partition(":")
+        if sep and rest and column.lower() in SEARCH_COLUMNS:
+            word = rest
+        else:
+            column = None
+
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if not word:
+            continue
+        term = '"' + word.replace('"', '""') + '"' + ("*" if prefix else "")
+        terms.append(f"{column.lower()} : {term}" if column else term)
+    return " ".join(terms)
 
 
 def prompt_user_contact():
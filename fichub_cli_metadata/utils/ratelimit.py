@@ -0,0 +1,233 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# requests per second for each host, "*" is used for the other hosts.
+# A rate of 0 disables the limit for the host
+DEFAULT_RATE_LIMITS = {"*": 5.0, "archiveofourown.org": 1.0}
+
+# responses which mean that the host wants us to slow down
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_rate_limits(spec: str):
+    """ Parse the --rate-limit option: either a single rate for all the
+        hosts e.g. "2" or host=rate pairs e.g. "fichub.net=5,archiveofourown.org=0.5"
+    """
+    rates = dict(DEFAULT_RATE_LIMITS)
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, rate = part.rpartition("=")
+        try:
+            rates[host.strip() or "*"] = max(float(rate), 0.0)
+        except ValueError:
+            raise ValueError(f"Invalid rate limit: '{part}'")
+    return rates
+
+
+def parse_retry_after(value: str):
+    """ Return the seconds to wait from a Retry-After header, given
+        either as seconds or as a HTTP date. None if it is missing/invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def backoff_delay(attempt: int, base: float = 2.0, cap: float = 300.0):
+    """ Exponential backoff with jitter for the nth attempt, so that the
+        retries from different workers dont line up
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def get_host(url: str):
+    host = urlparse(url).hostname or ""
+    return host[4:] if host.startswith("www.") else host
+
+
+class TokenBucket:
+    """ Allow `rate` requests per second with bursts of up to `burst`
+        requests. The rate is halved when the host throttles us & slowly
+        restored on the successful responses.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.max_rate = self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        # the tokens are refilled from this time, which is in the future
+        # while the host is paused
+        self.updated = time.monotonic()
+        self.strikes = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token, returns the seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens +
+                                  max(0.0, now - self.updated) * self.rate)
+                self.tokens -= 1
+            wait = max(0.0, self.updated - now)
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            self.updated = max(self.updated, now)
+            return wait
+
+    def throttle(self, retry_after: float = None):
+        """ Pause the host for `retry_after` seconds (or a backoff if it is
+            not given) & halve the rate
+        """
+        with self.lock:
+            self.strikes += 1
+            if retry_after is None:
+                retry_after = backoff_delay(self.strikes, base=1.0)
+            self.updated = max(self.updated, time.monotonic() + retry_after)
+            self.tokens = min(self.tokens, 0.0)
+            if self.rate:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+            return retry_after
+
+    def success(self):
+        with self.lock:
+            self.strikes = 0
+            if self.rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter:
+    """ Shared rate limiter for all the worker threads, with one token
+        bucket per host. Also keeps the time spent waiting for the report
+        at the end of the run.
+    """
+
+    def __init__(self, rates: dict = None):
+        self.rates = rates or dict(DEFAULT_RATE_LIMITS)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.throttled_time = 0.0
+        self.throttled_responses = 0
+
+    def bucket(self, url: str):
+        host = get_host(url)
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(
+                    self.rates.get(host, self.rates.get("*", 0.0)))
+            return self.buckets[host]
+
+    def acquire(self, url: str):
+        """ Block until a request to the url's host is allowed
+        """
+        wait = self.bucket(url).reserve()
+        if wait > 0:
+            with self.lock:
+                self.throttled_time += wait
+            time.sleep(wait)
+
+    def record(self, url: str, response):
+        """ Adapt the host's rate to the response. The status & the cache
+            validators are kept per thread, None if the request failed
+            without a response
+        """
+        self.local.status = None if response is None else response.status_code
+        if response is None:
+            self.local.validators = (None, None)
+            return
+        self.local.validators = (response.headers.get("ETag"),
+                                 response.headers.get("Last-Modified"))
+        if response.status_code in THROTTLE_STATUSES:
+            with self.lock:
+                self.throttled_responses += 1
+            return self.bucket(url).throttle(
+                parse_retry_after(response.headers.get("Retry-After")))
+        self.bucket(url).success()
+
+    @property
+    def last_status(self):
+        """ Status code of the last response in the current thread
+        """
+        return getattr(self.local, "status", None)
+
+    @property
+    def last_validators(self):
+        """ (ETag, Last-Modified) of the last response in the current thread
+        """
+        return getattr(self.local, "validators", (None, None))
+
+    def reset_status(self):
+        self.local.status = None
+        self.local.validators = (None, None)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """ Transport adapter which waits for the rate limiter before each
+        request. It doesnt retry the throttled responses itself, so a
+        worker is never stuck sleeping on a Retry-After; the failed urls
+        are retried at the end of the run instead.
+    """
+
+    def __init__(self, limiter: RateLimiter, **kwargs):
+        self.limiter = limiter
+        kwargs.setdefault("max_retries", Retry(connect=2, read=0, redirect=5))
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire(request.url)
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            self.limiter.record(request.url, None)
+            raise
+        self.limiter.record(request.url, response)
+        return response
+
+
+def pooled_session(limiter: RateLimiter, pool_size: int):
+    """ One keep-alive session for the whole run, shared by the worker
+        threads, with a connection pool per host big enough for all of them
+    """
+    http = requests.Session()
+    adapter = RateLimitedAdapter(limiter, pool_maxsize=pool_size)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    # also accepts brotli/zstd responses if their decoders are installed
+    http.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return http
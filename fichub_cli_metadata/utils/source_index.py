@@ -0,0 +1,110 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import math
+from loguru import logger
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from . import models
+
+# above this many rows, only keep a bloom filter of the sources in memory
+MAX_EXACT_ROWS = 500_000
+
+
+class BloomFilter:
+    """ Compact set membership test with no false negatives
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little")
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+class SourceIndex:
+    """ In-memory lookup table of the sources present in the db, loaded
+        with one query at the start of a run. Maps each source to its
+        (fichub_id, fic_last_updated).
+
+        For large dbs only a bloom filter of the sources is kept & the
+        positive hits are confirmed with an indexed query.
+    """
+
+    def __init__(self, db: Session, debug: bool, max_exact_rows: int = MAX_EXACT_ROWS):
+        self.db = db
+        self.rows = None
+        self.bloom = None
+
+        total = db.execute(
+            select(func.count()).select_from(models.Metadata)).scalar()
+
+        if total <= max_exact_rows:
+            self.rows = {}
+            for source, fichub_id, fic_last_updated in db.execute(
+                    select(models.Metadata.source, models.Metadata.fichub_id,
+                           models.Metadata.fic_last_updated)):
+                self.rows[source] = (fichub_id, fic_last_updated)
+        else:
+            # leave room for the rows added during the run
+            self.bloom = BloomFilter(total * 2)
+            for source, in db.execute(select(models.Metadata.source)):
+                if source is not None:
+                    self.bloom.add(source)
+
+        if debug:
+            logger.info(
+                f"Loaded {total} sources from the database into the {'exact' if self.bloom is None else 'bloom filter'} index.")
+
+    def get(self, source: str):
+        """ Return (fichub_id, fic_last_updated) for the source or None
+            if it is not in the db
+        """
+        if self.rows is not None:
+            return self.rows.get(source)
+
+        if source not in self.bloom:
+            return None
+
+        # bloom filters can give false positives, confirm with the db
+        row = self.db.execute(
+            select(models.Metadata.fichub_id, models.Metadata.fic_last_updated).where(
+                models.Metadata.source == source)).first()
+        return tuple(row) if row else None
+
+    def __contains__(self, source: str):
+        return self.get(source) is not None
+
+    def add(self, source: str, fichub_id: str, fic_last_updated: str):
+        if self.rows is not None:
+            self.rows[source] = (fichub_id, fic_last_updated)
+        else:
+            self.bloom.add(source)
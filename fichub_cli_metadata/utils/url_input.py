@@ -0,0 +1,128 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import io
+import os
+import sys
+from loguru import logger
+
+
+def is_input_file(input: str):
+    return input == "-" or os.path.isfile(input)
+
+
+def get_db_name(input: str):
+    """ Name the db after the input file, without the extensions
+    """
+    if input == "-":
+        return "stdin"
+    _, file_name = os.path.split(input)
+    if file_name.endswith(".gz"):
+        file_name = file_name[:-3]
+    return os.path.splitext(file_name)[0]
+
+
+def open_input(input: str):
+    """ Open the input file as text: "-" is stdin & .gz files are
+        decompressed on the fly
+    """
+    if input == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8",
+                                errors="ignore")
+    if input.endswith(".gz"):
+        return gzip.open(input, "rt", encoding="utf-8", errors="ignore")
+    return open(input, "r", encoding="utf-8", errors="ignore")
+
+
+def count_lines(input: str):
+    """ Number of lines in a plain input file, None for stdin & gzip
+        files which cant be read twice cheaply
+    """
+    if input == "-" or input.endswith(".gz"):
+        return None
+    lines = 0
+    with open(input, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            lines += chunk.count(b"\n")
+    return lines + 1
+
+
+class DigestSet:
+    """ Set of 64 bit digests of the urls, which takes a fraction of the
+        memory of a set of the url strings
+    """
+
+    def __init__(self):
+        self.digests = set()
+
+    @staticmethod
+    def digest(url: str):
+        return int.from_bytes(hashlib.blake2b(
+            url.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def add(self, url: str):
+        """ Add the url, returns False if it was already in the set
+        """
+        digest = self.digest(url)
+        if digest in self.digests:
+            return False
+        self.digests.add(digest)
+        return True
+
+    def __contains__(self, url: str):
+        return self.digest(url) in self.digests
+
+    def __len__(self):
+        return len(self.digests)
+
+
+def load_done_urls(debug: bool):
+    """ The urls in output.log & err.log, which are skipped like the CLI does
+    """
+    done = DigestSet()
+    for log_file in ("output.log", "err.log"):
+        if os.path.exists(log_file):
+            if debug:
+                logger.info(f"Checking {log_file}")
+            with open(log_file, "r") as f:
+                for line in f:
+                    done.add(normalize_url(line))
+    return done
+
+
+def normalize_url(url: str):
+    return str(url.strip().encode('ascii', 'ignore'), "utf-8")
+
+
+def read_urls(lines, changelog, debug: bool):
+    """ Lazily normalize & dedupe the input urls, skipping the ones in
+        output.log/err.log. The counts are kept in the changelog
+    """
+    seen = DigestSet()
+    done = load_done_urls(debug)
+
+    for line in lines:
+        url = normalize_url(line)
+        if not url:
+            continue
+        changelog.add("input", url)
+        if not seen.add(url):
+            continue
+        changelog.add("dedup", url)
+        if url in done:
+            continue
+        changelog.add("urls", url)
+        yield url
@@ -0,0 +1,91 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Only light imports here, this runs on the startup path of every command
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import typer
+from colorama import Fore, Style
+
+CHECK_INTERVAL = 24 * 60 * 60  # seconds
+
+
+def versiontuple(version: str):
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+
+def fetch_latest_version(package: str, cache_file: str):
+    """ Get the latest version from PyPI & cache it with the check time
+    """
+    # imported here, ssl & http are slow to import
+    import urllib.request
+
+    with urllib.request.urlopen(
+            f"https://pypi.org/pypi/{package}/json", timeout=5) as response:
+        latest_ver = json.load(response)["info"]["version"]
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, "w") as f:
+        json.dump({"checked": time.time(), "latest": latest_ver}, f)
+    return latest_ver
+
+
+def outdated_notice(package: str, current_ver: str, latest_ver: str):
+    if versiontuple(current_ver) < versiontuple(latest_ver):
+        typer.echo(
+            Fore.RED +
+            f"The currently installed {package} v{current_ver} is outdated.\n"
+            + Style.RESET_ALL + Fore.GREEN +
+            f"Latest version is {latest_ver}\n"
+            + Style.RESET_ALL + Fore.CYAN +
+            f"Update using: pip install -U {package}\n")
+
+
+def check_cli_outdated(package: str, current_ver: str, cache_dir: str):
+    """ Show a notice if the plugin is outdated, without blocking. The
+        latest version is cached on disk for a day, when it is stale it is
+        refreshed in a background thread & the notice is shown at exit
+        if the check finished by then
+    """
+    cache_file = os.path.join(cache_dir, f"{package}.version.json")
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+        if time.time() - cache["checked"] < CHECK_INTERVAL:
+            outdated_notice(package, current_ver, cache["latest"])
+            return
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    result = {}
+
+    def check():
+        try:
+            result["latest"] = fetch_latest_version(package, cache_file)
+        except Exception:
+            pass  # offline etc., try again on the next run
+
+    thread = threading.Thread(target=check, daemon=True)
+    thread.start()
+
+    def notice_at_exit():
+        if not thread.is_alive() and "latest" in result:
+            outdated_notice(package, current_ver, result["latest"])
+
+    atexit.register(notice_at_exit)
@@ -21,6 +21,10 @@ setup(
         'rich>=10.4.0',
         'sqlalchemy>=1.4.31'
     ],
+    extras_require={
+        'parquet': ['pyarrow>=7.0.0'],
+        'lxml': ['lxml>=4.6.0']
+    },
     entry_points= {
         'console_scripts': [
             'fichub_cli_metadata=fichub_cli_metadata.cli:app'
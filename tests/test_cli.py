@@ -15,6 +15,7 @@
 from typer.testing import CliRunner
 from fichub_cli_metadata.cli import app
 from fichub_cli_metadata import __version__
+from fichub_cli_metadata.utils import fetch_data
 
 
 def test_cli_url_input(tmpdir):
@@ -36,3 +37,20 @@ def test_cli_version():
     assert not result.exception
     assert result.exit_code == 0
     assert result.output.strip() == 'fichub-cli-metadata: v0.6.6'
+
+
+def test_cli_fetch_urls_workers(monkeypatch):
+    workers = []
+
+    def fetch_urls_from_page(self, fetch_urls, user_contact=None, pages=None):
+        workers.append(self.workers)
+    monkeypatch.setattr(fetch_data.FetchData, "fetch_urls_from_page",
+                        fetch_urls_from_page)
+
+    runner = CliRunner()
+    result = runner.invoke(app, [
+        '--fetch-urls', 'https://archiveofourown.org/tags/Fluff/works',
+        '--workers', '8'])
+
+    assert result.exit_code == 0
+    assert workers == [8]
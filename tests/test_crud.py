@@ -0,0 +1,398 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import json
+import os
+import requests
+from concurrent.futures import Future
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.sql import text
+
+from fichub_cli_metadata.utils import crud, models, migrations, fetch_data
+from fichub_cli_metadata.utils.cache import MetaCache
+from fichub_cli_metadata.utils.processing import init_database, get_db, match_query, \
+    get_ins_row
+from fichub_cli_metadata.utils.source_index import SourceIndex
+
+config = {'db_up_time_format': r'%Y-%m-%dT%H:%M:%S%z',
+          'fic_up_time_format': r'%Y-%m-%dT%H:%M:%S'}
+
+
+def make_item(n: int, words: int = 1000):
+    return {
+        "id": f"fichub{n}", "title": f"Title {n}", "author": "author",
+        "authorLocalId": 1, "authorUrl": "https://www.fanfiction.net/u/1",
+        "chapters": 2, "created": "2020-01-02T03:04:05",
+        "description": "description", "status": "ongoing", "words": words,
+        "updated": "2021-05-06T07:08:09",
+        "source": f"https://www.fanfiction.net/s/{n}/1/",
+        "rawExtendedMeta": None,
+        "extraMeta": "Rated: T - English - Romance - Reviews: 10"
+    }
+
+
+def open_db(tmp_path):
+    engine, SessionLocal = init_database(
+        os.path.join(tmp_path, "test.sqlite"))
+    models.Base.metadata.create_all(bind=engine)
+    return next(get_db(SessionLocal))
+
+
+def write_items(db, items, config=config, update=False, source_index=None):
+    """ Write the items with a BatchWriter, like the CLI. Returns the url
+        exit status for each item
+    """
+    writer = crud.BatchWriter(db, config, update, False, source_index=source_index)
+    results = [result for item in items for result in writer.add(item["source"], item)]
+    return [status for _, status in results + writer.flush()]
+
+
+def test_insert_skips_existing(tmp_path):
+    db = open_db(tmp_path)
+
+    assert write_items(db, [make_item(1), make_item(2)]) == [0, 0]
+    assert write_items(db, [make_item(2), make_item(3)]) == [2, 0]
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_metadata")).scalar() == 3
+
+
+def test_get_ins_row():
+    item = make_item(1)
+    item["created"] = ""  # stored as given, without a timestamp
+    row = get_ins_row(item, config)
+    assert (row["created"], row["created_ts"]) == ("", None)
+    assert row["fic_last_updated_ts"] == 1620284889
+
+
+def test_batch_db_last_updated(tmp_path):
+    db = open_db(tmp_path)
+    time_format = "%Y-%m-%d %H:%M:%S"  # local time, without an offset
+    write_items(db, [make_item(1), make_item(2)],
+                {**config, 'db_up_time_format': time_format})
+
+    # the batch is stamped once, the string & the timestamp agree
+    rows = set(db.execute(text(
+        "SELECT db_last_updated, db_last_updated_ts FROM fichub_metadata")))
+    assert len(rows) == 1
+    db_last_updated, db_last_updated_ts = rows.pop()
+    assert datetime.strptime(db_last_updated, time_format).timestamp() == db_last_updated_ts
+
+
+def test_update_upserts(tmp_path):
+    db = open_db(tmp_path)
+
+    write_items(db, [make_item(1)])
+    assert write_items(
+        db, [make_item(1, words=5000), make_item(2)], update=True) == [0, 0]
+
+    rows = db.execute(text(
+        "SELECT id, words FROM fichub_metadata ORDER BY id")).fetchall()
+    assert [tuple(row) for row in rows] == [(1, 5000), (2, 1000)]
+
+
+def test_migrate_legacy_db(tmp_path):
+    engine, SessionLocal = init_database(
+        os.path.join(tmp_path, "test.sqlite"))
+    with engine.connect() as conn:
+        conn.exec_driver_sql("CREATE TABLE fichub_metadata(id INTEGER NOT NULL, title VARCHAR(255), author VARCHAR(255), chapters INTEGER, created VARCHAR(255), description VARCHAR(255), rated VARCHAR(255), language VARCHAR(255), genre VARCHAR(255), characters VARCHAR(255), reviews INTEGER, favs INTEGER, follows INTEGER, status VARCHAR(255), words INTEGER, last_updated VARCHAR(255), source VARCHAR(255), PRIMARY KEY(id));")
+        conn.exec_driver_sql("INSERT INTO fichub_metadata (title, favs, last_updated, source, genre) VALUES ('a', 1, 'x', 'src1', 'Drama'), ('a', 1, 'x', 'src1', 'Drama'), ('b', '1,234', '2021-05-06T07:08:09', 'src2', 'Humor, Drama');")
+        conn.commit()
+
+    backups = []
+    migrations.migrate(engine, backups.append, False)
+    assert backups == ["pre.migration"]
+
+    # an up-to-date db is left alone
+    migrations.migrate(engine, backups.append, False)
+    assert backups == ["pre.migration"]
+
+    db = next(get_db(SessionLocal))
+    assert db.execute(text("PRAGMA user_version")).scalar() == migrations.SCHEMA_VERSION
+    rows = db.execute(text(
+        "SELECT id, favorites, fic_last_updated, source FROM fichub_metadata ORDER BY id")).fetchall()
+    assert [tuple(row) for row in rows] == [(1, 1, 'x', 'src1'), (3, 1234, '2021-05-06T07:08:09', 'src2')]
+    # the timestamps are backfilled from the dates which can be parsed
+    assert db.execute(text("SELECT fic_last_updated_ts FROM fichub_metadata ORDER BY id")).scalars().all() == \
+        [None, 1620284889]
+    # the tags of the existing rows are backfilled
+    assert db.execute(select(models.Metadata.id).where(
+        crud.tag_filter("genre", "drama"))).scalars().all() == [1, 3]
+
+    # the migrated schema works with the upsert
+    write_items(db, [make_item(1)], update=True)
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_metadata")).scalar() == 3
+
+
+def test_tags(tmp_path):
+    db = open_db(tmp_path)
+    items = [make_item(1), make_item(2)]
+    for item in items:
+        item["rawExtendedMeta"] = {"genres": "Romance, Drama"}
+    write_items(db, items)
+
+    def sources(*tags):
+        query = select(models.Metadata.source).where(
+            *(crud.tag_filter(kind, name) for kind, name in tags))
+        return db.execute(query.order_by(models.Metadata.id)).scalars().all()
+
+    assert sources(("genre", "romance")) == [items[0]["source"], items[1]["source"]]
+
+    # the tags are replaced on update
+    item = items[1]
+    item["rawExtendedMeta"] = {"genres": "Humor", "raw_fandom": "Harry Potter",
+                               "characters": "[Harry P., Hermione G.] Ron W."}
+    write_items(db, [item], update=True)
+    assert sources(("genre", "Romance")) == [items[0]["source"]]
+    assert sources(("character", "hermione g."), ("fandom", "Harry Potter")) == [item["source"]]
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_fic_tags")).scalar() == 7
+
+
+def test_source_index(tmp_path):
+    db = open_db(tmp_path)
+    write_items(db, [make_item(1), make_item(2)])
+    source = make_item(1)["source"]
+
+    for n, max_exact_rows in ((3, 10), (4, 0)):  # exact dict & bloom filter
+        index = SourceIndex(db, False, max_exact_rows=max_exact_rows)
+        assert index.get(source) == ("fichub1", "2021-05-06T07:08:09")
+        assert make_item(n)["source"] not in index
+
+        write_items(db, [make_item(n)], source_index=index)
+        assert make_item(n)["source"] in index
+        assert write_items(db, [make_item(n)], source_index=index) == [2]
+
+
+def test_checkpointed_run(tmp_path):
+    db = open_db(tmp_path)
+    run_id, done, resumed = crud.start_run(db, "update", "db", resume=True)
+    assert (done, resumed) == (set(), False)
+
+    writer = crud.BatchWriter(db, config, True, False, run_id=run_id)
+    writer.add(make_item(1)["source"], make_item(1))
+    writer.add_error("https://www.fanfiction.net/s/9/1/")
+    writer.flush()
+
+    # the interrupted run is continued, skipping the urls already done
+    assert crud.start_run(db, "update", "db", resume=True) == \
+        (run_id, {make_item(1)["source"]}, True)
+
+    writer.add_error("https://www.fanfiction.net/s/9/1/")
+    writer.flush()
+    assert db.execute(text(
+        "SELECT state, attempts FROM fichub_checkpoints WHERE url LIKE '%/9/1/'")).first() == ("error", 2)
+
+    # a complete run & its checkpoints are deleted
+    crud.finish_run(db, run_id)
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_checkpoints")).scalar() == 0
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_runs")).scalar() == 0
+    run_id = crud.start_run(db, "update", "db", resume=True)[0]
+
+    # a new run replaces the unfinished one, which cant be resumed anymore
+    writer = crud.BatchWriter(db, config, True, False, run_id=run_id)
+    writer.add_error("https://www.fanfiction.net/s/9/1/")
+    writer.flush()
+    new_run_id = crud.start_run(db, "update", "db", resume=False)[0]
+    assert db.execute(text("SELECT id FROM fichub_runs")).scalars().all() == [new_run_id]
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_checkpoints")).scalar() == 0
+
+
+def test_batch_writer_errors(tmp_path):
+    db = open_db(tmp_path)
+    index = SourceIndex(db, False)
+    writer = crud.BatchWriter(db, config, False, False, source_index=index)
+
+    # a malformed item is an error for its own url only
+    items = [make_item(n) for n in range(1, 4)]
+    items[1]["updated"] = "not a date"
+    results = [result for item in items for result in writer.add(item["source"], item)]
+    results += writer.flush()
+    assert sorted(results) == sorted([(items[0]["source"], 0), (items[1]["source"], None),
+                                      (items[2]["source"], 0)])
+    assert items[0]["source"] in index and items[1]["source"] not in index
+
+    # a batch which is rolled back is not added to the index
+    items = [make_item(n) for n in range(4, 6)]
+    items[1]["title"] = {"not": "a string"}
+    for item in items:
+        writer.add(item["source"], item)
+    assert writer.flush() == [(item["source"], None) for item in items]
+    assert items[0]["source"] not in index
+    assert write_items(db, [items[0]], source_index=index) == [0]
+
+
+def test_offline_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fetch_data, "load_config", lambda debug: config)
+    cache = MetaCache(str(tmp_path), ttl=60, max_size=10 ** 6)
+    for n in (1, 2):
+        cache.put(make_item(n)["source"], make_item(n))
+    cache.close()
+
+    with open("urls.txt", "w") as f:
+        f.write("\n".join(make_item(n)["source"] for n in (1, 2, 3)))
+
+    # the db is built from the cache, the url missing from it is an error
+    fic = fetch_data.FetchData(offline=True, cache_dir=str(tmp_path),
+                               out_dir=str(tmp_path), no_backup=True)
+    fic.save_metadata("urls.txt")
+    assert fic.exit_status == 1
+    assert fic.db.execute(text("SELECT COUNT(*) FROM fichub_metadata")).scalar() == 2
+
+
+def test_force_refetches_cache(tmp_path, monkeypatch):
+    fetched = []
+
+    def fetch_meta(self, fic, url, cached=None):
+        fetched.append((url, cached is not None))
+        self.use_cached(fic, cached)
+    monkeypatch.setattr(fetch_data.FetchData, "fetch_meta", fetch_meta)
+
+    url = make_item(1)["source"]
+    for force in (False, True):
+        fic = fetch_data.FetchData(cache_dir=str(tmp_path), force=force)
+        fic.open_cache()
+        fic.cache.put(url, make_item(1))
+        fic.fetch_fic(url)
+        fic.cache.close()
+
+    # a fresh entry is only used without --force, which revalidates it
+    assert fetched == [(url, True)]
+
+
+def test_db_backup(tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_data, "load_config", lambda debug: config)
+
+    # a new db has nothing to backup
+    fic = fetch_data.FetchData(out_dir=str(tmp_path))
+    fic.create_database("urls")
+    fic.db.close()
+    assert glob.glob(os.path.join(tmp_path, "*.pre.*")) == []
+
+    old_backups = []
+    for n in (1, 2):
+        old_backups.append(fic.db_file[:-len(".sqlite")] +
+                           f".pre.update - 2020-01-0{n} T000000.sqlite")
+        open(old_backups[-1], "w").close()
+        os.utime(old_backups[-1], (n * 1000, n * 1000))
+
+    # an existing db is backed up at most once per run & only the latest
+    # backups are kept
+    fic = fetch_data.FetchData(input_db=fic.db_file, keep_backups=2)
+    fic.create_database("urls")
+    fic.db_backup("pre.migration")
+    fic.db.close()
+    backups = glob.glob(os.path.join(tmp_path, "*.pre.*"))
+    assert len(backups) == 2 and old_backups[1] in backups
+    assert old_backups[0] not in backups
+
+
+def test_query_without_config(tmp_path, monkeypatch):
+    def load_config(debug):
+        raise AssertionError("the config is not needed")
+    monkeypatch.setattr(fetch_data, "load_config", load_config)
+
+    db_file = os.path.join(tmp_path, "test.sqlite")
+    engine, SessionLocal = init_database(db_file)
+    migrations.migrate(engine, None, False)
+    write_items(next(get_db(SessionLocal)), [make_item(1)])
+
+    out_file = os.path.join(tmp_path, "out.csv")
+    fic = fetch_data.FetchData(input_db=db_file)
+    fic.query_db(["title"], {}, output_format="csv", out_file=out_file)
+    assert fic.exit_status == 0
+    with open(out_file) as f:
+        assert f.read().split() == ["title", "Title", "1"]
+
+
+def test_should_retry():
+    fic = fetch_data.FetchData()
+
+    def failed(err):
+        future = Future()
+        future.set_exception(err)
+        return future
+
+    # only the transient errors are retried, not the bugs
+    assert fic.should_retry(failed(requests.exceptions.ConnectionError()))
+    assert fic.should_retry(failed(json.JSONDecodeError("", "", 0)))
+    assert not fic.should_retry(failed(KeyError("meta")))
+    assert not fic.should_retry(failed(TypeError()))
+
+
+def test_search(tmp_path):
+    engine, SessionLocal = init_database(os.path.join(tmp_path, "test.sqlite"))
+    migrations.migrate(engine, None, False)  # a new db gets the search index
+    db = next(get_db(SessionLocal))
+
+    items = [make_item(n) for n in range(1, 4)]
+    items[0]["description"] = "A dragon rider story"
+    items[1]["title"] = "Dragons"
+    write_items(db, items)
+
+    total, rows = crud.search_rows(db, match_query("drag*"), limit=10)
+    assert total == 2 and [row.title for row in rows] == ["Dragons", "Title 1"]
+    assert crud.search_rows(db, match_query("title:dragon*"), limit=10)[0] == 1
+    assert [row.title for row in crud.search_rows(db, match_query("drag*"), 1, 1)[1]] == ["Title 1"]
+
+    # the index follows the updates
+    items[1]["title"] = "Wyverns"
+    write_items(db, [items[1]], update=True)
+    assert crud.search_rows(db, match_query("title:drag*"), limit=10)[0] == 0
+    assert crud.search_rows(db, match_query("wyvern*"), limit=10)[0] == 1
+
+
+def test_query_rows(tmp_path):
+    db = open_db(tmp_path)
+    items = [make_item(n, words=n * 1000) for n in range(1, 6)]
+    items[3]["status"] = "complete"
+    items[4]["updated"] = "2023-01-01T00:00:00"
+    items[4]["rawExtendedMeta"] = {"genres": "Humor"}
+    write_items(db, items)
+
+    def sources(**kwargs):
+        return [source for source, in crud.query_rows(db, ["source"], **kwargs)]
+
+    assert sources(min_words=2000, max_words=4000, sort="-words") == \
+        [items[n]["source"] for n in (3, 2, 1)]
+    assert sources(status="complete") == [items[3]["source"]]
+    assert sources(sort="-words", limit=2) == [items[4]["source"], items[3]["source"]]
+    assert sources(tags=[("genre", "humor")]) == [items[4]["source"]]
+
+    assert sources(updated_since=datetime(2022, 6, 1)) == [items[4]["source"]]
+    assert sources(sort="-fic_last_updated", limit=1) == [items[4]["source"]]
+
+
+def test_trending(tmp_path):
+    engine, SessionLocal = init_database(os.path.join(tmp_path, "test.sqlite"))
+    migrations.migrate(engine, None, False)  # a new db gets the history trigger
+    db = next(get_db(SessionLocal))
+
+    items = [make_item(n) for n in range(1, 4)]
+    write_items(db, items)
+    write_items(db, items, update=True)  # unchanged, no history
+    assert db.execute(text("SELECT COUNT(*) FROM fichub_metadata_history;")).scalar() == 0
+
+    items[0]["words"] += 500
+    items[2]["words"] += 2000
+    write_items(db, items, update=True)
+    items[0]["words"] += 3000
+    write_items(db, items, update=True)
+
+    rows = list(crud.trending_rows(db, "words", 0, limit=10))
+    assert [(row.growth, row.title) for row in rows] == \
+        [(3500, "Title 1"), (2000, "Title 3")]
+    assert rows[0].words == 4500
+    assert list(crud.trending_rows(db, "words", 0, limit=1))[0].title == "Title 1"
+    assert list(crud.trending_rows(db, "chapters", 0, limit=10)) == []
@@ -0,0 +1,240 @@
+# Copyright 2022 Arbaaz Laskar
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import os
+import pytest
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from fichub_cli_metadata.utils.processing import needs_refresh, match_query, \
+    fetch_concurrently, to_epoch, local_timestamp
+from fichub_cli_metadata.utils.export import to_int, write_parquet
+from fichub_cli_metadata.utils import extract
+from fichub_cli_metadata.utils.extract import parse_pages
+from fichub_cli_metadata.utils.changelog import Changelog
+from fichub_cli_metadata.utils.url_input import read_urls, open_input, get_db_name
+from fichub_cli_metadata.utils.cache import MetaCache
+from fichub_cli_metadata.utils.ratelimit import TokenBucket, parse_rate_limits, \
+    parse_retry_after
+
+config = {'db_up_time_format': r'%Y-%m-%dT%H:%M:%S%z',
+          'fic_up_time_format': r'%Y-%m-%dT%H:%M:%S'}
+
+
+def days_ago(days: int):
+    return int((datetime.now().astimezone() - timedelta(days=days)).timestamp())
+
+
+def test_fetch_concurrently():
+    lock = threading.Lock()
+    state = {"running": 0, "max_running": 0, "pulled": 0}
+
+    def urls(count):
+        for n in range(count):
+            state["pulled"] += 1
+            yield n
+
+    def fetch(n):
+        with lock:
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+        time.sleep(0.2 if n == 0 else 0.001)
+        with lock:
+            state["running"] -= 1
+        return n * 2
+
+    # the input is read lazily, one url per freed slot
+    results = fetch_concurrently(fetch, urls(20), 3)
+    first = next(results)
+    assert state["pulled"] <= 4
+    results = [first] + list(results)
+
+    # each result is paired with its url, in completion order so a slow
+    # url doesnt hold back the others
+    assert sorted(url for url, _ in results) == list(range(20))
+    assert all(future.result() == url * 2 for url, future in results)
+    assert results[-1][0] == 0
+    assert state["max_running"] <= 3
+
+
+def test_fetch_concurrently_interrupted():
+    release = threading.Event()
+    pulled = []
+
+    def urls():
+        for n in range(10):
+            pulled.append(n)
+            yield n
+
+    def fetch(n):
+        if n:
+            release.wait(5)
+        return n
+
+    results = fetch_concurrently(fetch, urls(), 2)
+    with pytest.raises(KeyboardInterrupt):
+        for url, future in results:
+            raise KeyboardInterrupt
+
+    # stops without waiting for the in-flight fetch or reading more urls
+    start = time.monotonic()
+    results.close()
+    assert time.monotonic() - start < 1
+    assert pulled == [0, 1]
+    release.set()
+
+
+def test_needs_refresh():
+    # never fetched or unparseable timestamps
+    assert needs_refresh("ongoing", None, None, 90)
+    assert needs_refresh("ongoing", None, days_ago(10), 90)
+
+    # completed fics wait for the ttl
+    assert not needs_refresh("complete", days_ago(900), days_ago(10), 90)
+    assert needs_refresh("complete", days_ago(900), days_ago(91), 90)
+
+    # ongoing fics back off with their staleness
+    assert needs_refresh("ongoing", days_ago(1), days_ago(0), 90)
+    assert needs_refresh("ongoing", days_ago(3), days_ago(1), 90)
+    assert not needs_refresh("ongoing", days_ago(40), days_ago(10), 90)
+    assert needs_refresh("ongoing", days_ago(40), days_ago(16), 90)
+    assert not needs_refresh("ongoing", days_ago(2000), days_ago(29), 90)
+
+
+def test_to_epoch():
+    assert to_epoch("2021-05-06T07:08:09") == 1620284889
+    assert to_epoch("06/05/2021 07:08", "%d/%m/%Y %H:%M") == 1620284880
+    assert to_epoch("2021-05-06T07:08:09+0200", config['db_up_time_format']) == 1620277689
+    assert to_epoch("garbage", config['db_up_time_format']) is None
+
+
+def test_local_timestamp(monkeypatch):
+    monkeypatch.setenv("TZ", "Asia/Kolkata")  # UTC+05:30
+    time.tzset()
+    try:
+        # a naive date/time is in the local time, for --since & --updated-since
+        assert local_timestamp(datetime(2021, 5, 6, 12, 38, 9)) == 1620284889
+        assert local_timestamp(
+            datetime(2021, 5, 6, 7, 8, 9, tzinfo=timezone.utc)) == 1620284889
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_export_to_int():
+    assert to_int("1,234") == 1234
+    assert to_int(12) == 12
+    assert to_int(None) is None
+    assert to_int("n/a") is None
+
+
+def test_write_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    out_file = os.path.join(tmp_path, "out.parquet")
+    write_parquet(out_file, ["id", "author_id", "words"],
+                  [(1, "flamethrower", "1,234"), (2, 42, None)])
+    assert pq.read_table(out_file).to_pydict() == {
+        "id": [1, 2], "author_id": ["flamethrower", "42"], "words": [1234, None]}
+
+
+def test_rate_limits():
+    assert parse_rate_limits("2")["*"] == 2.0
+    assert parse_rate_limits("fichub.net=5, archiveofourown.org=0") == \
+        {"*": 5.0, "fichub.net": 5.0, "archiveofourown.org": 0.0}
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+
+    bucket = TokenBucket(rate=10)
+    # the burst is allowed, then the requests are spaced out
+    waits = [bucket.reserve() for _ in range(12)]
+    assert waits[:10] == [0.0] * 10 and 0.05 < waits[11] < 0.25
+
+    # a throttled host is paused for the Retry-After & slowed down
+    bucket.throttle(retry_after=30)
+    assert bucket.reserve() > 29 and bucket.rate == 5
+
+
+def test_parse_listing():
+    assert parse_pages("all") == (1, None)
+    assert parse_pages("3-") == (3, None)
+    assert parse_pages("2-5") == (2, 5)
+    assert parse_pages("4") == (4, 4)
+
+    page = b"""<ol class="pagination actions"><li><a href="/tags/x/works?page=1">1</a></li>
+        <li><a href="/tags/x/works?page=40">40</a></li>
+        <li class="next"><a rel="next" href="/tags/x/works?page=3">Next</a></li></ol>
+        <h4 class="heading"><a href="/works/1">A</a> by <a href="/users/u">u</a></h4>
+        <h4 class="heading"><a href="/series/2">B</a></h4>"""
+    parsers = [extract.parse_listing_soup]
+    if extract.lxml_html is not None:
+        parsers.append(extract.parse_listing_lxml)
+    for parse_listing in parsers:
+        assert parse_listing(page, "https://archiveofourown.org/tags/x/works?page=2") == (
+            ["https://archiveofourown.org/works/1"], ["https://archiveofourown.org/series/2"],
+            40, "https://archiveofourown.org/tags/x/works?page=3")
+
+
+def test_read_urls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("output.log", "w") as f:
+        f.write("https://archiveofourown.org/works/2\n")
+    with gzip.open("urls.txt.gz", "wt") as f:
+        f.write("https://archiveofourown.org/works/1\n\nhttps://archiveofourown.org/works/2\n"
+                "https://archiveofourown.org/works/1 \nhttps://archiveofourown.org/works/3\n")
+
+    changelog = Changelog(str(tmp_path), save=True)
+    with open_input("urls.txt.gz") as lines:
+        assert list(read_urls(lines, changelog, False)) == [
+            "https://archiveofourown.org/works/1", "https://archiveofourown.org/works/3"]
+    assert get_db_name("urls.txt.gz") == "urls"
+
+    changelog.add("downloaded", "https://archiveofourown.org/works/1")
+    changelog.save()
+    changelog_file, = [f for f in os.listdir(tmp_path) if f.startswith("CHANGELOG")]
+    with open(changelog_file) as f:
+        text = f.read()
+    assert "Total URLs given as input: 4\nTotal URLs after removing duplicates: 3\n" \
+        "Total URLs after comparing with the output.log: 2\nTotal URLs/Files downloaded: 1\n" in text
+    assert text.endswith("## URLs/Files Downloaded\nhttps://archiveofourown.org/works/1")
+
+
+def test_meta_cache(tmp_path):
+    cache = MetaCache(str(tmp_path), ttl=60, max_size=10 ** 6)
+    assert cache.get("https://archiveofourown.org/works/1") is None
+
+    cache.put("https://archiveofourown.org/works/1/", {"title": "A"}, etag='"v1"')
+    cached = cache.get("HTTPS://ArchiveOfOurOwn.org/works/1#main")
+    assert cached.meta == {"title": "A"} and cached.etag == '"v1"'
+    assert cache.is_fresh(cached)
+    assert not cache.is_fresh(cached._replace(fetched=cached.fetched - 61))
+
+    # the least recently used entries are evicted over the max size
+    for n in range(2, 40):
+        cache.put(f"https://archiveofourown.org/works/{n}", {"title": "x" * 1000 + str(n)})
+    cache.get("https://archiveofourown.org/works/1")
+    cache.max_size = 400
+    cache.close()
+    cache = MetaCache(str(tmp_path), ttl=60, max_size=400)
+    assert cache.get("https://archiveofourown.org/works/1") is not None
+    assert cache.get("https://archiveofourown.org/works/2") is None
+    assert cache.get("https://archiveofourown.org/works/39") is not None
+
+
+def test_match_query():
+    assert match_query("Harry's drag*") == '"Harry\'s" "drag"*'
+    assert match_query('title:"dragon" Author:x fandom: *') == 'title : """dragon""" author : "x" "fandom:"'
+    assert match_query(" * ") == ""